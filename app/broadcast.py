@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from typing import Callable
+
+from app.wire import JSON, MSGPACK, WIRE_FORMATS, broadcast_frames, encode
+from project import settings
+
+logger = logging.getLogger("broadcast")
+
+BROADCAST_TICK = getattr(settings, "BROADCAST_TICK", 0.0)
+
+
+def empty_tick() -> dict:
+    return {"pools": {}, "investments": [], "deleted": [], "seq": {}, "ids": []}
+
+
+def add_event(tick: dict, data: dict, seq: dict | None = None, event_id: str | None = None) -> None:
+    # Pools are state: keep only the latest merged value per id. Investment
+    # changes and deletions are events and are all kept, in order, with the
+    # id of their event so a socket can leave out ones it already got.
+    pool = data.get("pool", None)
+    if pool and pool.get("id", None) is not None:
+        tick["pools"].setdefault(str(pool["id"]), {}).update(pool)
+    if data.get("investment", None):
+        tick["investments"].append([event_id, data["investment"]])
+    if data.get("deleted", None):
+        tick["deleted"].append([event_id, data["deleted"]])
+    if event_id is not None:
+        tick["ids"].append(event_id)
+    # Newest event log id per stream covered by this tick (see app.events).
+    tick["seq"].update(seq or {})
+
+
+def merge_tick(earlier: dict, later: dict) -> dict:
+    merged = empty_tick()
+    for tick in (earlier, later):
+        for pool_id, pool in tick["pools"].items():
+            merged["pools"].setdefault(pool_id, {}).update(pool)
+        merged["investments"] += tick["investments"]
+        merged["deleted"] += tick["deleted"]
+        merged["seq"].update(tick.get("seq", {}))
+        merged["ids"] += tick.get("ids", [])
+    return merged
+
+
+def without_events(tick: dict, ids: set) -> dict:
+    """``tick`` minus the investment changes and deletions of the events in ``ids``."""
+    return {
+        **tick,
+        "investments": [entry for entry in tick["investments"] if entry[0] not in ids],
+        "deleted": [entry for entry in tick["deleted"] if entry[0] not in ids],
+        "ids": [event_id for event_id in tick["ids"] if event_id not in ids],
+    }
+
+
+def encode_tick(tick: dict, codec: str = JSON) -> str | bytes:
+    return encode({
+        "type": "tick",
+        "seq": tick.get("seq", {}),
+        "data": {
+            "pools": list(tick["pools"].values()),
+            "investments": [inv for _, inv in tick["investments"]],
+            "deleted": [inv for _, inv in tick["deleted"]],
+        }
+    }, codec)
+
+
+class TickScheduler:
+    """
+    Collects pool and investment events per target group and sends each group
+    one ``tick`` frame every ``interval`` seconds instead of one frame per
+    event. The merge-able ``data`` travels along with the encoded frame so a
+    slow socket can fold an unsent tick into the next one (see ``app.outbox``).
+
+    Each event can come with an ``entry`` (the listener's stream entry);
+    ``on_sent`` gets the entries of a tick once every group they went to
+    was sent, so they are only acknowledged after delivery.
+    """
+
+    def __init__(self, channel_layer, interval: float = BROADCAST_TICK,
+                 on_sent: Callable[[list], None] | None = None):
+        self.channel_layer = channel_layer
+        self.interval = interval
+        self.on_sent = on_sent
+        self._pending: dict[str, dict] = {}
+        self._entries: list[tuple[object, list[str]]] = []
+
+    def add(self, groups: list[str], data: dict, seq: dict | None = None, entry=None,
+            event_id: str | None = None) -> None:
+        for group in groups:
+            tick = self._pending.get(group, None)
+            if tick is None:
+                tick = self._pending[group] = empty_tick()
+            add_event(tick, data, seq, event_id)
+        if entry is not None:
+            self._entries.append((entry, groups))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._pending:
+                continue
+
+            pending, self._pending = self._pending, {}
+            entries, self._entries = self._entries, []
+            results = await asyncio.gather(*(
+                self.channel_layer.group_send(group, {
+                    "type": "tick",
+                    "key": "tick",
+                    **broadcast_frames(
+                        encode_tick(tick), encode_tick(tick, MSGPACK) if MSGPACK in WIRE_FORMATS else None,
+                    ),
+                    "data": tick,
+                    "ts": time.time(),
+                })
+                for group, tick in pending.items()
+            ), return_exceptions=True)
+            failed = set()
+            for group, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    logger.error(f"tick broadcast to {group} failed: {result!r}")
+                    failed.add(group)
+            if self.on_sent is not None:
+                self.on_sent([entry for entry, groups in entries if failed.isdisjoint(groups)])
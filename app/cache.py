@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import time
+from decimal import Decimal
+from typing import Callable
+
+from app.db import database_sync_to_async
+from app.models import TradePool, TradeInvestment
+from app.redis_pool import get_redis
+from app.serializers import TradePoolSerializer, TradeInvestmentSerializer, trade_pool_fast, trade_investment_fast
+from app.sharding import POOLS_CHANNEL
+from app.wire import Prefix, pack
+from project import settings
+
+logger = logging.getLogger("cache")
+
+SNAPSHOT_CACHE_MAX_ROWS = getattr(settings, "SNAPSHOT_CACHE_MAX_ROWS", 200_000)
+SNAPSHOT_CACHE_RECONCILE_INTERVAL = getattr(settings, "SNAPSHOT_CACHE_RECONCILE_INTERVAL", 300)
+
+# Pool columns an update event may change; the rest only come from a create
+# event on the pools channel or from the DB.
+POOL_UPDATE_FIELDS = ("curr_value", "in_amount", "is_closed", "total_invested", "investor_count")
+
+
+class SnapshotCache:
+    """
+    Process-level read model of all pools and investments, loaded once from the
+    DB and then patched from the ``main.*`` pub/sub events. Drift (missed
+    events, increments applied twice around a reload) is corrected by a full
+    reload every ``reconcile_interval`` seconds. If the tables outgrow
+    ``max_rows`` the cache turns itself off and callers fall back to the DB.
+    """
+
+    def __init__(self, max_rows: int = SNAPSHOT_CACHE_MAX_ROWS,
+                 reconcile_interval: float = SNAPSHOT_CACHE_RECONCILE_INTERVAL):
+        self.max_rows = max_rows
+        self.reconcile_interval = reconcile_interval
+        self.ready = False
+        self.pools_version = 0
+        self.invs_version = 0
+
+        self._pools: dict[str, dict] = {}
+        self._invs: dict[tuple[str, str], dict] = {}
+        self._sorted_pools: tuple[int, list[dict]] = (-1, [])
+        self._pools_json: tuple[int, str] = (-1, "[]")
+        self._invs_json: tuple[int, str] = (-1, "[]")
+        self._pools_msgpack: tuple[int, bytes] = (-1, b"")
+        self._invs_msgpack: tuple[int, bytes] = (-1, b"")
+        self._prefixes: dict[str, tuple[tuple[int, int], Prefix]] = {}
+        self._pool_fields = TradePoolSerializer().fields
+        self._inv_fields = TradeInvestmentSerializer().fields
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def pools(self) -> list[dict]:
+        version, pools = self._sorted_pools
+        if version != self.pools_version:
+            pools = sorted(self._pools.values(), key=lambda p: Decimal(p.get("curr_value", None) or 0))
+            self._sorted_pools = (self.pools_version, pools)
+        return pools
+
+    def invs(self) -> list[dict]:
+        return list(self._invs.values())
+
+    # Encoded payloads are cached per data version, so every auth between two
+    # changes reuses the same string.
+    def pools_json(self) -> str:
+        version, encoded = self._pools_json
+        if version != self.pools_version:
+            encoded = json.dumps(self.pools())
+            self._pools_json = (self.pools_version, encoded)
+        return encoded
+
+    def invs_json(self) -> str:
+        version, encoded = self._invs_json
+        if version != self.invs_version:
+            encoded = json.dumps(self.invs())
+            self._invs_json = (self.invs_version, encoded)
+        return encoded
+
+    def pools_msgpack(self) -> bytes:
+        version, encoded = self._pools_msgpack
+        if version != self.pools_version:
+            encoded = pack(self.pools())
+            self._pools_msgpack = (self.pools_version, encoded)
+        return encoded
+
+    def invs_msgpack(self) -> bytes:
+        version, encoded = self._invs_msgpack
+        if version != self.invs_version:
+            encoded = pack(self.invs())
+            self._invs_msgpack = (self.invs_version, encoded)
+        return encoded
+
+    def prefix(self, codec: str, head: Callable[[], str | bytes]) -> Prefix:
+        # The compressed frame start built by ``head``, per codec and data
+        # version of both tables.
+        version = (self.pools_version, self.invs_version)
+        cached = self._prefixes.get(codec, None)
+        if cached is None or cached[0] != version:
+            cached = self._prefixes[codec] = (version, Prefix(head()))
+        return cached[1]
+
+    async def _run(self) -> None:
+        while True:
+            pubsub = get_redis().pubsub()
+            try:
+                # Subscribe before loading so nothing published during the
+                # load is missed.
+                await pubsub.psubscribe("main.*")
+                await self.reload()
+                reconcile_at = time.monotonic() + self.reconcile_interval
+
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg is not None and msg["type"] == "pmessage":
+                        try:
+                            self.apply(msg["channel"], msg["data"])
+                        except (ValueError, TypeError, KeyError, ArithmeticError) as ex:
+                            # One malformed event: skip it, keep the cache.
+                            logger.warning(f"skipping event on {msg['channel']}: {ex!r}")
+
+                    if time.monotonic() >= reconcile_at:
+                        await self.reload()
+                        reconcile_at = time.monotonic() + self.reconcile_interval
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.exception(str(ex))
+                self.ready = False
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def reload(self) -> None:
+        loaded = await self.db_load(self.max_rows)
+        if loaded is None:
+            logger.warning(f"snapshot cache disabled: more than {self.max_rows} rows")
+            self._pools, self._invs = {}, {}
+            self.ready = False
+        else:
+            pools, invs = loaded
+            self._pools = {p["id"]: p for p in pools}
+            self._invs = {(i["user_id"], i["pool_id"]): i for i in invs}
+            self.ready = True
+        self.pools_version += 1
+        self.invs_version += 1
+
+    @staticmethod
+    @database_sync_to_async
+    def db_load(max_rows: int) -> tuple[list, list] | None:
+        if TradePool.objects.count() + TradeInvestment.objects.count() > max_rows:
+            return None
+        return (
+            trade_pool_fast.serialize(TradePool.objects.all()),
+            trade_investment_fast.serialize(TradeInvestment.objects.all()),
+        )
+
+    def apply(self, channel: str, raw: str) -> None:
+        if not self.ready or "dash" in channel:
+            return
+
+        data = json.loads(raw)
+        pool = data.get("pool", None)
+        if pool and pool.get("id", None) is not None:
+            pool_id = str(pool["id"])
+            current = self._pools.get(pool_id, None)
+            if current is not None:
+                changes = {name: pool[name] for name in POOL_UPDATE_FIELDS if name in pool}
+                current.update(self._coerce(self._pool_fields, changes))
+                self.pools_version += 1
+            elif channel.startswith(POOLS_CHANNEL) and self._pool_fields.keys() <= pool.keys():
+                # A new pool: only a full row is cached. An update of a pool
+                # this cache has not seen yet waits for the next reload.
+                self._pools[pool_id] = {"id": pool_id, **self._coerce(self._pool_fields, pool)}
+                self.pools_version += 1
+
+        inv = data.get("investment", None)
+        if inv:
+            key = (str(inv["user_id"]), str(inv["pool_id"]))
+            current = self._invs.get(key, None)
+            if current is None:
+                self._invs[key] = {
+                    "id": inv.get("id", None),
+                    "user_id": key[0],
+                    "pool_id": key[1],
+                    **self._coerce(self._inv_fields, {"input": inv.get("input", 0)}),
+                }
+            elif inv.get("amount", None) is not None:
+                total = Decimal(current["input"]) + Decimal(str(inv["amount"]))
+                current.update(self._coerce(self._inv_fields, {"input": total}))
+            self.invs_version += 1
+
+        deleted = data.get("deleted", None)
+        if deleted:
+            self._invs.pop((str(deleted["user_id"]), str(deleted["pool_id"])), None)
+            self.invs_version += 1
+
+        if len(self._pools) + len(self._invs) > self.max_rows:
+            logger.warning(f"snapshot cache disabled: more than {self.max_rows} rows")
+            self._pools, self._invs = {}, {}
+            self.ready = False
+
+    @staticmethod
+    def _coerce(fields: dict, data: dict) -> dict:
+        # Run client-supplied values through the serializer fields so cached
+        # rows look exactly like the DB-serialized ones.
+        out = {}
+        for name, value in data.items():
+            field = fields.get(name, None)
+            if field is None or name == "id":
+                continue
+            if value is None:
+                out[name] = None
+            elif hasattr(field, "decimal_places"):
+                out[name] = field.to_representation(Decimal(str(value)))
+            else:
+                out[name] = field.to_representation(value)
+        return out
+
+
+snapshot_cache = SnapshotCache()
@@ -1,74 +1,81 @@
 import json
+import time
 import typing
 import uuid
 import logging
-from urllib.parse import parse_qsl
+from decimal import Decimal
+from urllib.parse import parse_qs, parse_qsl
 
-import redis
-
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.db.models import F
 
-from app.models import TelegramUser, TradePool, TradeInvestment
-from app.serializers import TelegramUserSerializer, TradePoolSerializer, TradeInvestmentSerializer
+from app import events
+from app.cache import snapshot_cache
+from app.db import database_sync_to_async
+from app.dispatch import NUMBER, NULLABLE_NUMBER, Registry, ValidationError
+from app.leaderboard import leaderboard
+from app.metrics import REDIS_CALL_SECONDS, WS_BYTES_SENT, WS_CONNECTIONS, WS_DELIVERY_LAG_SECONDS, WS_FRAMES_SENT, WS_HANDLER_ERRORS, sampled, start_server
+from app.models import TelegramUser, TradePool, TradeInvestment, TradeInvestmentTombstone
+from app.outbox import Outbox
+from app.serializers import TelegramUserSerializer, TradePoolSerializer, TradeInvestmentSerializer, trade_pool_fast, trade_investment_fast
+from app.session import Session, user_cache
+from app.sharding import INVESTMENTS_CHANNEL, POOLS_CHANNEL
+from app.snapshot import changes_page
+from app.topics import MAIN_GROUP, POOLS_GROUP, DASH_GROUP, MAX_SUBSCRIPTIONS, event_groups, pool_group, user_group
 from app.utils import verify_telegram_init_data
+from app.valuation import VALUATION_ENABLED
+from app.wire import JSON, MSGPACK, WIRE_FORMATS, COMPRESS_THRESHOLD, compress, decode, encode, is_compressed, map_header, pack
+from app.writebehind import clean_investment, clean_pool, inv_key, write_behind
 
 logger = logging.getLogger("channels")
 
-redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
+handlers = Registry()
+
 
 class PoolConsumer(AsyncWebsocketConsumer):
     @classmethod
-    def update_dashboard(cls, key: str, value: int = 0) -> None:
-        redis_client.zadd("dashboard", {key: value})
-        redis_client.publish(
-            "main.dash_channel",
-            json.dumps(redis_client.zrange("dashboard", 0, 3, withscores=True))
-        )
+    async def update_dashboard(cls, key: str, value: int = 0) -> None:
+        await leaderboard.set_score(key, value)
 
     @classmethod
-    def load_dashboard(cls) -> list[dict]:
-        return json.dumps(redis_client.zrange("dashboard", 0, 3, withscores=True))
+    async def load_dashboard(cls) -> list[list]:
+        return await leaderboard.top()
 
     @classmethod
-    def delete_user_from_dashboard(cls, key: str) -> None:
-        redis_client.zrem("dashboard", key)
-        redis_client.publish(
-            "main.dash_channel",
-            json.dumps(redis_client.zrange("dashboard", 0, 3, withscores=True))
-        )
+    async def delete_user_from_dashboard(cls, key: str) -> None:
+        await leaderboard.remove(key)
 
     @classmethod
-    def publish_pool(cls, pool: object) -> None:
-        redis_client.publish("main.pools_channel", json.dumps({
+    async def publish_pool(cls, pool: object) -> None:
+        message = {
             "pool": pool
-        }))
+        }
+        with REDIS_CALL_SECONDS.labels("publish").time():
+            await events.publish(POOLS_CHANNEL, message)
 
     @classmethod
-    def publish_investment(cls, pool: dict, inv: dict | None = None) -> None:
-        redis_client.publish("main.investments_channel", json.dumps({
+    async def publish_investment(cls, pool: dict, inv: dict | None = None, deleted: dict | None = None) -> None:
+        message = {
             "pool": pool,
             "investment": inv
-        }))
-
+        }
+        if deleted is not None:
+            message["deleted"] = deleted
+        with REDIS_CALL_SECONDS.labels("publish").time():
+            await events.publish(INVESTMENTS_CHANNEL, message)
 
-    @classmethod
-    @database_sync_to_async
-    def db_user_check(cls, user_id: uuid.UUID) -> bool | typing.NoReturn:
-        try:
-            return TelegramUser.objects.filter(id=user_id).exists()
-        except Exception as ex:
-            logger.exception(str(ex))
 
     @classmethod
     @database_sync_to_async
-    def db_user_create(cls, data: dict) -> TelegramUser | typing.NoReturn:
+    def db_user_get_or_create(cls, data: dict) -> tuple[dict, bool] | typing.NoReturn:
         try:
-            user_id = uuid.UUID(data["id"])
-            username = data.get("username", None)
-            photo_url = data.get("photo_url", None)
-            return TelegramUser.objects.create(id=user_id, username=username, img=photo_url)
+            user, created = TelegramUser.objects.get_or_create(
+                id=uuid.UUID(data["id"]),
+                defaults={
+                    "username": data.get("username", None),
+                    "img": data.get("photo_url", None),
+                },
+            )
+            return TelegramUserSerializer(user).data, created
         except Exception as ex:
             logger.exception(str(ex))
 
@@ -91,6 +98,18 @@ class PoolConsumer(AsyncWebsocketConsumer):
         except Exception as ex:
             logger.exception(str(ex))
 
+    async def get_user(self, user_id: uuid.UUID) -> dict | None:
+        user_id = uuid.UUID(str(user_id))
+        if self.session is not None and self.session.user_id == user_id:
+            return self.session.user
+
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await self.db_user_get(user_id)
+            if user is not None:
+                user_cache.put(user_id, user)
+        return user
+
     # @classmethod
     # @database_sync_to_async
     # def db_user_trade_pools(cls, user_id: uuid.UUID) -> dict:
@@ -131,23 +150,6 @@ class PoolConsumer(AsyncWebsocketConsumer):
         except Exception as ex:
             logger.debug(str(ex))
 
-    @classmethod
-    @database_sync_to_async
-    def db_trade_pool_update(cls, data: dict = None) -> None | typing.NoReturn:
-        try:
-            TradePool.objects.filter(id=data["id"]).update(curr_value=data["curr_value"], in_amount=data["in_amount"])
-            # obj = TradePool.objects.get(id=data["id"])
-            # obj.curr_value = data["currValue"]
-            # obj.in_amount = data["inAmount"]
-            # obj.save()
-            #
-            # ser = TradePoolSerializer(obj)
-            #
-            # return ser.data
-
-        except Exception as ex:
-            logger.exception(str(ex))
-
     # @database_sync_to_async
     # def db_trade_pool_get(self, trade_pool_id):
     #     try:
@@ -160,150 +162,431 @@ class PoolConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def db_trade_pool_get_all(cls) -> dict | typing.NoReturn:
         try:
-            objs = TradePool.objects.all().order_by('curr_value')
-            ser = TradePoolSerializer(objs, many=True)
-            return ser.data
-        except Exception as ex:
-            logger.exception(str(ex))
-
-    @classmethod
-    @database_sync_to_async
-    def db_trade_inv_check(cls, data: dict) -> bool | typing.NoReturn:
-        try:
-            return TradeInvestment.objects.filter(user_id=data["user_id"], pool_id=data["pool_id"]).exists()
-        except Exception as ex:
-            logger.exception(str(ex))
-
-    @classmethod
-    @database_sync_to_async
-    def db_trade_inv_create(cls, data: dict) -> None | typing.NoReturn:
-        try:
-            _ = TradeInvestment.objects.create(
-                user_id=data["user_id"],
-                pool_id=data["pool_id"],
-                input=data["input"],
-            )
-
+            return trade_pool_fast.serialize(TradePool.objects.all().order_by('curr_value'))
         except Exception as ex:
             logger.exception(str(ex))
 
     @classmethod
     @database_sync_to_async
-    def db_trade_inv_update(cls, data: dict) -> None | typing.NoReturn:
-        # logger.debug(f"db_trade_inv_update, data: {data}")
-        try:
-            TradeInvestment.objects.filter(user=data["user_id"], trade_idea=data["pool_id"]).update(input=F('input') + data["amount"])
-            # ser = TradeInvestmentSerializer(obj)
-            #
-            # return ser.data
-        except Exception as ex:
-            logger.exception(str(ex))
+    def db_trade_pool_changes(cls, cursor: str | None = None, page_size: int | None = None) -> dict:
+        return changes_page(TradePool.objects.all(), TradePoolSerializer, cursor, page_size)
 
     @classmethod
     @database_sync_to_async
     def db_trade_inv_get_all(cls) -> dict | typing.NoReturn:
         try:
-            objs = TradeInvestment.objects.all()
-            ser = TradeInvestmentSerializer(objs, many=True)
-            return ser.data
+            return trade_investment_fast.serialize(TradeInvestment.objects.all())
         except Exception as ex:
             logger.exception(str(ex))
 
     @classmethod
     @database_sync_to_async
-    def db_trade_inv_delete(cls, data: dict) -> None | typing.NoReturn:
-        try:
-            TradeInvestment.objects.filter(user_id=data["user_id"], pool_id=data["pool_id"]).delete()
-
-        except Exception as ex:
-            logger.exception(str(ex))
-
+    def db_trade_inv_changes(cls, cursor: str | None = None, page_size: int | None = None) -> dict:
+        return changes_page(
+            TradeInvestment.objects.all(), TradeInvestmentSerializer, cursor, page_size,
+            tombstones=TradeInvestmentTombstone.objects.all(),
+        )
 
     async def connect(self):
-        self.room_group_name = "main"
+        self.room_group_name = MAIN_GROUP
+        self.topics: set[str] = set()
+        self.session: Session | None = None
+        self.codec, subprotocol = self.negotiate_codec()
+        self.compress = self.query_param("compress") == "zlib"
 
         logger.info(f"WebSocket connection established: {self.channel_name} to group {self.room_group_name}")
 
+        await start_server()
+        snapshot_cache.start()
+        user_cache.start()
+        self.outbox = Outbox(self.send_encoded, self.codec, on_evict=self.evict)
+        self.outbox.start()
+
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol)
+        WS_CONNECTIONS.inc()
+
+    def query_param(self, name: str) -> str | None:
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        return query.get(name, [None])[0]
+
+    def negotiate_codec(self) -> tuple[str, str | None]:
+        # Either the "msgpack" subprotocol or ?format=msgpack selects msgpack.
+        if MSGPACK in WIRE_FORMATS:
+            if MSGPACK in self.scope.get("subprotocols", []):
+                return MSGPACK, MSGPACK
+            if self.query_param("format") == MSGPACK:
+                return MSGPACK, None
+        return JSON, None
+
+    async def send_encoded(self, frame: str | bytes) -> None:
+        # ?compress=zlib: only frames above the threshold are worth the CPU.
+        # Broadcasts and cached snapshots may come compressed already.
+        if self.compress and len(frame) >= COMPRESS_THRESHOLD and not is_compressed(frame):
+            frame = compress(frame)
+
+        if isinstance(frame, str):
+            await self.send(text_data=frame)
+            kind = "text"
+        else:
+            await self.send(bytes_data=frame)
+            kind = "binary"
+        WS_FRAMES_SENT.labels(kind).inc()
+        WS_BYTES_SENT.labels(kind).inc(len(frame))
+        self.outbox.frames_sent += 1
+
+    async def evict(self) -> None:
+        # Still behind after a resync: the client reconnects and re-auths
+        # with its last seq instead.
+        logger.warning(f"Evicting slow consumer {self.channel_name}: {self.outbox.dropped} frames dropped")
+        await self.close(code=4008)
+
+    async def send_frame(self, message: dict) -> None:
+        await self.send_encoded(encode(message, self.codec))
+
+    @staticmethod
+    def auth_head(codec: str) -> str | bytes:
+        # An auth frame up to the cached pools and investments; on_user_auth
+        # appends user, dash and seq.
+        if codec == MSGPACK:
+            return (
+                map_header(3) + pack("type") + pack("auth") + pack("data") + map_header(4)
+                + pack("pools") + snapshot_cache.pools_msgpack() + pack("invs") + snapshot_cache.invs_msgpack()
+            )
+        return (
+            '{"type": "auth", "data": {"pools": ' + snapshot_cache.pools_json()
+            + ', "invs": ' + snapshot_cache.invs_json()
+        )
 
     async def disconnect(self, code):
         logger.info(f"WebSocket disconnected: {self.channel_name} from group {self.room_group_name} with code {code}")
 
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        for group in {self.room_group_name, *self.topics}:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.outbox.stop()
+        WS_CONNECTIONS.dec()
+
+    async def subscribe(self, groups: list[str]) -> None:
+        if self.room_group_name == MAIN_GROUP:
+            # First subscription: stop receiving the whole market.
+            await self.channel_layer.group_discard(MAIN_GROUP, self.channel_name)
+            self.room_group_name = POOLS_GROUP
+            groups = [POOLS_GROUP, DASH_GROUP, *groups]
+
+        for group in groups:
+            if group not in self.topics:
+                await self.channel_layer.group_add(group, self.channel_name)
+                self.topics.add(group)
+
+    async def unsubscribe(self, groups: list[str]) -> None:
+        for group in groups:
+            if group in self.topics:
+                await self.channel_layer.group_discard(group, self.channel_name)
+                self.topics.discard(group)
 
     async def receive(self, text_data=None, bytes_data=None):
-        data = json.loads(text_data)
-        m_type = data["type"]
-        action = data["action"]
-        params = data["params"]
-
-        if m_type == "user":
-            if action == "auth":
-                user_data = await self.verif(params["init_data"])
-                user_id = uuid.UUID(user_data["id"])
-
-                if not await self.db_user_check(user_id):
-                    await self.db_user_create(user_data)
-                    self.update_dashboard(user_id)
-
-                leaderboard = json.loads(self.load_dashboard())
-                user = await self.db_user_get(user_id)
-                pools = await self.db_trade_pool_get_all()
-                invs = await self.db_trade_inv_get_all()
-
-                await self.send(text_data=json.dumps({
-                    "type": "auth",
-                    "data": {
-                        "user": user,
-                        "pools": pools,
-                        "invs": invs,
-                        "dash": leaderboard
-                    }
-                }))
-
-            else:
-                user_id = params["user_id"]
-                if action == "update":
-                    pnl = params["pnl"]
-                    self.update_dashboard(user_id, pnl)
-                    await self.db_user_get(user_id)
-
-                elif action == "delete":
-                    await self.db_user_delete(user_id)
-                    self.delete_user_from_dashboard(user_id)
-
-                elif action == "get":
-                    await self.db_user_get(user_id)
+        try:
+            data = decode(text_data if text_data is not None else bytes_data, self.codec)
+        except Exception:
+            await self.send_error("Malformed message", code="malformed")
+            return
+
+        if not isinstance(data, dict):
+            await self.send_error("Malformed message", code="malformed")
+            return
+
+        m_type = data.get("type", None)
+        action = data.get("action", None)
+        handler = handlers.resolve(m_type, action)
+        if handler is None:
+            await self.send_error(f"Unknown action: {m_type}/{action}", code="unknown_action")
+            return
 
-        elif m_type == "trade_pool":
-            if action == "create":
-                pool = await self.db_trade_pool_create(params)
-                self.publish_pool(pool)
+        try:
+            params = handler.validate(data.get("params", None))
+        except ValidationError as ex:
+            await self.send_error(str(ex), code="invalid_params")
+            return
 
-            elif action == "update":
-                investment_data = params.get("investment", None)
-                pool_data = params.get("pool", None)
+        try:
+            await handlers.dispatch(handler, self, params)
+        except Exception as ex:
+            logger.exception(str(ex))
+            await self.send_error("Internal error", code="internal")
+
+    @handlers.handler("user", "auth", required={"init_data": str}, optional={"snapshot": dict, "since": dict})
+    async def on_user_auth(self, params: dict) -> None:
+        user_data = await self.verif(params["init_data"])
+        if not user_data or "id" not in user_data:
+            return
+        user_id = uuid.UUID(str(user_data["id"]))
+
+        # One get_or_create round trip; reconnects within the cache
+        # TTL skip the DB entirely.
+        user = user_cache.get(user_id)
+        if user is None:
+            result = await self.db_user_get_or_create(user_data)
+            if result is None:
+                await self.send_error("Some problems with user verification", code="auth")
+                return
+            user, created = result
+            if created:
+                await self.update_dashboard(user_id)
+            user_cache.put(user_id, user)
+        self.session = Session(user_id, user)
+
+        dash = await self.load_dashboard()
+
+        since = params.get("since", None)
+        if since is not None:
+            # Resume: the client kept its state and the "seq" of the last
+            # frames it got; the missed events replace the snapshot. If the
+            # log no longer covers the gap this falls through to a full one.
+            try:
+                entries = await events.replay(since)
+            except ValueError as ex:
+                await self.send_error(str(ex), code="invalid_params")
+                return
+            if entries is not None:
+                await self.send_frame({
+                    "type": "auth",
+                    "data": {"user": user, "dash": dash, "resumed": True}
+                })
+                self.send_replay(entries)
+                return
+
+        # Taken before the snapshot is read: events after it may already be
+        # in the snapshot, but none between the two can be missed.
+        seq = await events.last_ids()
+
+        snapshot = params.get("snapshot", None)
+        if snapshot is not None:
+            # Paged delta mode: only rows changed after the client's
+            # last cursor, one page per table; the rest is pulled
+            # with type=snapshot messages.
+            page_size = snapshot.get("page_size", None)
+            try:
+                pools = await self.db_trade_pool_changes(snapshot.get("pools", None), page_size)
+                invs = await self.db_trade_inv_changes(snapshot.get("invs", None), page_size)
+            except ValueError as ex:
+                await self.send_error(str(ex), code="invalid_params")
+                return
+        elif snapshot_cache.ready:
+            # Pools and investments come first, already encoded (and
+            # compressed) by the cache; only the per-user tail is
+            # serialized and compressed here.
+            if self.codec == MSGPACK:
+                tail = pack("user") + pack(user) + pack("dash") + pack(dash) + pack("seq") + pack(seq)
+            else:
+                tail = (
+                    ', "user": ' + json.dumps(user) + ', "dash": ' + json.dumps(dash)
+                    + '}, "seq": ' + json.dumps(seq) + '}'
+                )
+            if self.compress:
+                prefix = snapshot_cache.prefix(self.codec, lambda: self.auth_head(self.codec))
+                if prefix.size + len(tail) >= COMPRESS_THRESHOLD:
+                    await self.send_encoded(prefix.compress(tail))
+                    return
+            await self.send_encoded(self.auth_head(self.codec) + tail)
+            return
+        else:
+            pools = await self.db_trade_pool_get_all()
+            invs = await self.db_trade_inv_get_all()
+
+        await self.send_frame({
+            "type": "auth",
+            "seq": seq,
+            "data": {
+                "user": user,
+                "pools": pools,
+                "invs": invs,
+                "dash": dash
+            }
+        })
+
+    @handlers.handler("user", "update", required={"user_id": str, "pnl": NUMBER})
+    async def on_user_update(self, params: dict) -> None:
+        # The valuation engine keeps TelegramUser.pnl and the leaderboard;
+        # a client-reported pnl only counts without it.
+        if not VALUATION_ENABLED:
+            await self.update_dashboard(params["user_id"], params["pnl"])
+        await self.get_user(params["user_id"])
+
+    @handlers.handler("user", "delete", required={"user_id": str})
+    async def on_user_delete(self, params: dict) -> None:
+        user_id = uuid.UUID(params["user_id"])
+        await self.db_user_delete(user_id)
+        # UserCache is not thread-safe: only the event loop touches it.
+        user_cache.invalidate(user_id)
+        await self.delete_user_from_dashboard(user_id)
+        if self.session is not None and self.session.user_id == user_id:
+            self.session = None
+
+    @handlers.handler("user", "get", required={"user_id": str})
+    async def on_user_get(self, params: dict) -> None:
+        await self.get_user(params["user_id"])
+
+    @handlers.handler("user", "rank", required={"user_id": str})
+    async def on_user_rank(self, params: dict) -> None:
+        await self.send_frame({
+            "type": "rank",
+            "data": await leaderboard.rank(params["user_id"])
+        })
+
+    @handlers.handler("trade_pool", "create", required={
+        "user_id": str, "active": str, "is_long": bool, "is_order": bool, "order": NULLABLE_NUMBER,
+        "final_amount": NUMBER, "stop_loss": NUMBER, "take_profit": NUMBER, "leverage": NUMBER,
+    })
+    async def on_trade_pool_create(self, params: dict) -> None:
+        pool = await self.db_trade_pool_create(params)
+        await self.publish_pool(pool)
+
+    @staticmethod
+    def client_pool(pool_data: dict) -> dict:
+        """
+        What is published and written of a client's pool update: the id and
+        checked POOL_FIELDS, as the serializer renders them. Everything else
+        (entry price, leverage, ...) is the server's. ValueError if invalid.
+        """
+        pool = clean_pool(pool_data)
+        # With the valuation engine on, pool values are computed server-side.
+        if VALUATION_ENABLED:
+            pool.pop("curr_value", None)
+        return {name: f"{value:f}" if isinstance(value, Decimal) else value for name, value in pool.items()}
+
+    @handlers.handler("trade_pool", "update", required={"pool": dict, "investment": dict})
+    async def on_trade_pool_update(self, params: dict) -> None:
+        investment_data = params["investment"]
+        # Checked up front so a bad update is neither published nor half queued.
+        try:
+            pool_data = self.client_pool(params["pool"])
+            clean_investment(investment_data)
+        except ValueError as ex:
+            await self.send_error(str(ex), code="invalid_params")
+            return
+        if write_behind.full:
+            await self.send_error("Writes are unavailable, try again later", code="unavailable")
+            return
+
+        await self.publish_investment(pool_data, investment_data)
+        write_behind.update_pool(pool_data)
+        write_behind.upsert_investment(investment_data)
+
+    @handlers.handler("investment", "delete", required={"pool": dict, "investment": dict})
+    async def on_investment_delete(self, params: dict) -> None:
+        investment_data = params["investment"]
+        try:
+            pool_data = self.client_pool(params["pool"])
+            inv_key(investment_data)
+        except ValueError as ex:
+            await self.send_error(str(ex), code="invalid_params")
+            return
+        if write_behind.full:
+            await self.send_error("Writes are unavailable, try again later", code="unavailable")
+            return
+
+        await self.publish_investment(pool_data, deleted=investment_data)
+        write_behind.update_pool(pool_data)
+        write_behind.delete_investment(investment_data)
+
+    async def send_snapshot_page(self, kind: str, changes, params: dict) -> None:
+        try:
+            page = await changes(params.get("cursor", None), params.get("page_size", None))
+        except ValueError as ex:
+            await self.send_error(str(ex), code="invalid_params")
+            return
 
-                self.publish_investment(pool_data, investment_data)
-                await self.db_trade_pool_update(pool_data)
+        await self.send_frame({
+            "type": "snapshot",
+            "data": {"kind": kind, **page}
+        })
 
-                if await self.db_trade_inv_check(investment_data):
-                    # logger.info("TRADE INVESTMENT UPDATE")
-                    await self.db_trade_inv_update(investment_data)
-                else:
-                    # logger.info("TRADE INVESTMENT CREATE")
-                    await self.db_trade_inv_create(investment_data)
+    @handlers.handler("snapshot", "pools", optional={"cursor": (str, type(None)), "page_size": (int, type(None))})
+    async def on_snapshot_pools(self, params: dict) -> None:
+        await self.send_snapshot_page("pools", self.db_trade_pool_changes, params)
 
-        elif m_type == "investment":
-            if action == "delete":
-                pool_data = params["pool"]
-                investment_data = params["investment"]
-                self.publish_investment(pool_data)
-                await self.db_trade_pool_update(pool_data)
-                await self.db_trade_inv_delete(investment_data)
+    @handlers.handler("snapshot", "invs", optional={"cursor": (str, type(None)), "page_size": (int, type(None))})
+    async def on_snapshot_invs(self, params: dict) -> None:
+        await self.send_snapshot_page("invs", self.db_trade_inv_changes, params)
 
+    async def subscription_groups(self, params: dict) -> list[str] | None:
+        try:
+            groups = [pool_group(p) for p in params.get("pools", [])]
+            groups += [user_group(u) for u in params.get("users", [])]
+        except ValueError:
+            await self.send_error("Invalid pool or user id", code="invalid_params")
+            return None
+        return groups
+
+    async def send_subscriptions(self) -> None:
+        await self.send_frame({
+            "type": "subscription",
+            "data": sorted(self.topics)
+        })
+
+    @handlers.handler("subscription", "subscribe", optional={"pools": list, "users": list})
+    async def on_subscribe(self, params: dict) -> None:
+        groups = await self.subscription_groups(params)
+        if groups is None:
+            return
+        if len((self.topics | set(groups)) - {POOLS_GROUP, DASH_GROUP}) > MAX_SUBSCRIPTIONS:
+            await self.send_error(f"At most {MAX_SUBSCRIPTIONS} subscriptions per connection", code="limit")
+            return
+        await self.subscribe(groups)
+        await self.send_subscriptions()
+
+    @handlers.handler("subscription", "unsubscribe", optional={"pools": list, "users": list})
+    async def on_unsubscribe(self, params: dict) -> None:
+        groups = await self.subscription_groups(params)
+        if groups is None:
+            return
+        await self.unsubscribe(groups)
+        await self.send_subscriptions()
+
+    def send_replay(self, entries: list[tuple]) -> None:
+        # Queued behind anything already in the outbox; clients drop frames
+        # whose seq they have already seen.
+        groups = {self.room_group_name, *self.topics}
+        count = 0
+        for stream, entry_id, channel, raw in entries:
+            m_type = events.message_type(channel)
+            data = json.loads(raw)
+            if groups.isdisjoint(event_groups(m_type, data)):
+                continue
+            seq = {stream: entry_id}
+            if self.codec == MSGPACK:
+                frame = events.pack_frame(m_type, data, seq)
+            else:
+                frame = events.encode_frame(m_type, raw, data, seq)
+            self.outbox.put(None, frame)
+            count += 1
+        self.outbox.put(None, encode({"type": "replay", "data": {"count": count}}, self.codec))
 
+    @handlers.handler("events", "replay", required={"since": dict})
+    async def on_events_replay(self, params: dict) -> None:
+        try:
+            entries = await events.replay(params["since"])
+        except ValueError as ex:
+            await self.send_error(str(ex), code="invalid_params")
+            return
+        if entries is None:
+            await self.send_error("Event log does not reach back far enough", code="resync")
+            return
+        self.send_replay(entries)
+
+    @handlers.handler("events", "ack", required={"received": int})
+    async def on_events_ack(self, params: dict) -> None:
+        # Number of frames the client has received on this socket; sent
+        # every second or so, it lets the outbox see a slow reader.
+        self.outbox.ack(params["received"])
+
+    async def send_error(self, message: str, code: str = "error") -> None:
+        WS_HANDLER_ERRORS.labels(code).inc()
+        await self.send_frame({
+            "type": "error",
+            "code": code,
+            "message": message
+        })
 
     async def verif(self, init_data_str: str) -> dict:
         init_data = dict(parse_qsl(init_data_str))
@@ -312,31 +595,39 @@ class PoolConsumer(AsyncWebsocketConsumer):
             return json.loads(init_data.get('user', '{}'))
 
         else:
-            await self.send(text_data=json.dumps({
-                "type": "error",
-                "message": "Some problems with user verification"
-            }))
+            await self.send_error("Some problems with user verification", code="auth")
+
+    # Broadcast frames are encoded once by the listener and queued as-is.
+    def broadcast_frame(self, event: dict) -> str | bytes:
+        # The "_z" variants are only there for frames worth compressing.
+        if self.codec == MSGPACK:
+            frame = (self.compress and event.get("bytes_z", None)) or event.get("bytes", None)
+            return frame if frame is not None else pack(json.loads(event["text"]))
+        return (self.compress and event.get("text_z", None)) or event["text"]
+
+    def queue_broadcast(self, event: dict, data: dict | None = None) -> None:
+        # Time spent in the channel layer: if this grows, raise its capacity
+        # or lower expiry before clients start seeing gaps.
+        if "ts" in event:
+            WS_DELIVERY_LAG_SECONDS.labels(event["type"]).observe(time.time() - event["ts"])
+        # Only a socket with topics can get one event through two groups.
+        ids = None
+        if self.topics:
+            ids = (data if data is not None else event).get("ids", None)
+        self.outbox.put(event.get("key", None), self.broadcast_frame(event), data, droppable=True, ids=ids)
 
     async def dash(self, event):
-        data = event['data']
-        data = json.loads(data)
-        logger.info(f"Dashboard update received: {data}")
-
-        await self.send(text_data=json.dumps({
-            'type': 'dash',
-            'data': data
-        }))
+        if sampled():
+            logger.info("Dashboard update received: %s", event["text"])
+        self.queue_broadcast(event)
 
     async def pool(self, event):
-        data = event["data"]
-        data = json.loads(data)
-        # data = json.loads(data["pool"])
-        logger.info(f"Pools updatye received: {data}")
+        if sampled():
+            logger.info("Pools update received: %s", event["text"])
+        self.queue_broadcast(event)
 
-        await self.send(text_data=json.dumps({
-            "type": "pool",
-            "data": data["pool"]
-        }))
+    async def tick(self, event):
+        self.queue_broadcast(event, event["data"])
 
     # async def update_pool(self, event):
     #     data = json.loads(event["data"])
@@ -350,14 +641,9 @@ class PoolConsumer(AsyncWebsocketConsumer):
     #     }))
 
     async def investment(self, event):
-        data = json.loads(event["data"])
-
-        logger.info(f"New investment: {data}")
-
-        await self.send(text_data=json.dumps({
-            "type": "investment",
-            "data": data
-        }))
+        if sampled():
+            logger.info("New investment: %s", event["text"])
+        self.queue_broadcast(event)
 
     # async def user_update(self, username: str, wallet: str | None = None, pnl: int | None =None) -> None:
     #     try:
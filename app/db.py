@@ -0,0 +1,47 @@
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+
+from app.metrics import DB_CALL_SECONDS, DB_QUEUE_WAIT_SECONDS, Gauge
+from project import settings
+
+# Upper bound on DB threads, and so on Postgres connections, per process:
+# each worker thread keeps its own Django connection, reused across calls
+# for CONN_MAX_AGE seconds (set it, with CONN_HEALTH_CHECKS, in DATABASES).
+DB_MAX_WORKERS = getattr(settings, "DB_MAX_WORKERS", 16)
+
+executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="db")
+
+DB_IN_FLIGHT = Gauge("db_calls_in_flight", "database_sync_to_async calls queued or running")
+
+
+def database_sync_to_async(func):
+    """
+    ``channels.db.database_sync_to_async`` on the bounded ``executor`` instead
+    of asgiref's single thread-sensitive thread, recording how long the call
+    waited for a worker thread and how long it ran there. Connections are
+    still closed or recycled around each call by ``DatabaseSyncToAsync``.
+    """
+    call_seconds = DB_CALL_SECONDS.labels(func.__name__)
+
+    def run(submitted: float, args, kwargs):
+        started = time.perf_counter()
+        DB_QUEUE_WAIT_SECONDS.observe(started - submitted)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            call_seconds.observe(time.perf_counter() - started)
+
+    run_async = DatabaseSyncToAsync(run, thread_sensitive=False, executor=executor)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        DB_IN_FLIGHT.inc()
+        try:
+            return await run_async(time.perf_counter(), args, kwargs)
+        finally:
+            DB_IN_FLIGHT.dec()
+
+    return wrapper
@@ -0,0 +1,86 @@
+import time
+import typing
+
+from app.metrics import WS_HANDLER_SECONDS
+
+NUMBER = (int, float, str)
+NULLABLE_NUMBER = (int, float, str, type(None))
+
+
+class ValidationError(Exception):
+    pass
+
+
+class Handler:
+    """
+    One registered (type, action) handler with its precompiled param checks
+    and its call statistics.
+    """
+
+    def __init__(self, m_type: str, action: str, func: typing.Callable,
+                 required: dict[str, type | tuple] | None = None,
+                 optional: dict[str, type | tuple] | None = None):
+        self.m_type = m_type
+        self.action = action
+        self.func = func
+        self.checks = [(name, types, True) for name, types in (required or {}).items()]
+        self.checks += [(name, types, False) for name, types in (optional or {}).items()]
+
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.histogram = WS_HANDLER_SECONDS.labels(f"{m_type}/{action}")
+
+    def validate(self, params) -> dict:
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            raise ValidationError("params must be an object")
+        for name, types, required in self.checks:
+            if name not in params:
+                if required:
+                    raise ValidationError(f"missing param: {name}")
+                continue
+            if not isinstance(params[name], types):
+                raise ValidationError(f"invalid param: {name}")
+        return params
+
+    def record(self, seconds: float, failed: bool) -> None:
+        self.histogram.observe(seconds)
+        self.calls += 1
+        self.seconds += seconds
+        if failed:
+            self.errors += 1
+
+
+class Registry:
+    def __init__(self):
+        self.handlers: dict[tuple[str, str], Handler] = {}
+
+    def handler(self, m_type: str, action: str, required: dict | None = None, optional: dict | None = None):
+        def decorator(func):
+            self.handlers[(m_type, action)] = Handler(m_type, action, func, required, optional)
+            return func
+        return decorator
+
+    def resolve(self, m_type, action) -> Handler | None:
+        try:
+            return self.handlers.get((m_type, action), None)
+        except TypeError:
+            # unhashable type/action values from a malformed message
+            return None
+
+    async def dispatch(self, handler: Handler, consumer, params: dict) -> None:
+        started = time.perf_counter()
+        failed = True
+        try:
+            await handler.func(consumer, params)
+            failed = False
+        finally:
+            handler.record(time.perf_counter() - started, failed)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            f"{h.m_type}/{h.action}": {"calls": h.calls, "errors": h.errors, "seconds": h.seconds}
+            for h in self.handlers.values()
+        }
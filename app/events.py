@@ -0,0 +1,142 @@
+"""
+Event log: every pool, investment and dashboard event is appended to a capped
+Redis Stream as well as published. The listener forwards events from the
+streams through a consumer group, so nothing is lost while it restarts, and
+every frame carries its stream ids (``seq``) so a reconnecting client can
+replay what it missed instead of downloading a full snapshot.
+
+The plain PUBLISH stays for the in-process readers (snapshot cache,
+valuation engine) that only care about live updates.
+"""
+import json
+import time
+
+from app.redis_pool import PUBSUB_SHARDS, get_redis
+from app.sharding import DASH_CHANNEL, DASH_STREAM, EVENT_STREAM, pubsub_channel, routing_key, streams
+from app.wire import pack
+from project import settings
+
+# Approximate length each stream is trimmed to (XADD MAXLEN ~).
+EVENT_LOG_MAXLEN = getattr(settings, "EVENT_LOG_MAXLEN", 100_000)
+# Replays longer than this get a "resync" error instead.
+EVENT_REPLAY_LIMIT = getattr(settings, "EVENT_REPLAY_LIMIT", 1000)
+
+LISTENER_GROUP = "listener"
+
+
+def message_type(channel: str) -> str:
+    if "dash" in channel:
+        return "dash"
+    elif "pool" in channel:
+        return "pool"
+    return "investment"
+
+
+def event_id(stream: str, entry_id: str) -> str:
+    # Unique across streams (entry ids are only unique within one).
+    return f"{stream}/{entry_id}"
+
+
+def encode_frame(m_type: str, raw: str, data, seq: dict | None = None) -> str:
+    # Build the socket frame once; consumers send it without re-parsing.
+    head = '{"type": "' + m_type + '", "seq": ' + json.dumps(seq or {}) + ', "data": '
+    if m_type == "pool":
+        return head + json.dumps(data["pool"]) + '}'
+    return head + raw + '}'
+
+
+def pack_frame(m_type: str, data, seq: dict | None = None) -> bytes:
+    return pack({
+        "type": m_type,
+        "seq": seq or {},
+        "data": data["pool"] if m_type == "pool" else data,
+    })
+
+
+def queue(pipe, channel: str, message: dict) -> None:
+    """
+    Add one event (XADD + PUBLISH) to a pipeline; ``channel`` is the unsharded
+    name. The entry's "ts" field (publish time, for the listener's lag metric)
+    stays outside the payload clients get.
+    """
+    key = routing_key(message)
+    raw = json.dumps(message)
+    channel = pubsub_channel(channel, key, PUBSUB_SHARDS)
+    stream = DASH_STREAM if channel == DASH_CHANNEL else pubsub_channel(EVENT_STREAM, key, PUBSUB_SHARDS)
+    pipe.xadd(stream, {"channel": channel, "data": raw, "ts": time.time()}, maxlen=EVENT_LOG_MAXLEN, approximate=True)
+    pipe.publish(channel, raw)
+
+
+async def publish(channel: str, message: dict) -> None:
+    async with get_redis().pipeline(transaction=False) as pipe:
+        queue(pipe, channel, message)
+        await pipe.execute()
+
+
+def parse_id(entry_id: str) -> tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+async def last_ids() -> dict[str, str]:
+    """
+    Newest id of every event stream that exists: the ``seq`` of a snapshot
+    read right after this call, so a client can resume from it.
+    """
+    known = streams(PUBSUB_SHARDS)
+    async with get_redis().pipeline(transaction=False) as pipe:
+        for stream in known:
+            pipe.xinfo_stream(stream)
+        results = await pipe.execute(raise_on_error=False)
+    return {
+        stream: info["last-generated-id"]
+        for stream, info in zip(known, results)
+        if not isinstance(info, Exception)
+    }
+
+
+async def replay(since: dict[str, str], limit: int = EVENT_REPLAY_LIMIT) -> list[tuple] | None:
+    """
+    Entries after the client's last seen ids, oldest first, as
+    (stream, id, channel, raw). Streams the client has no id for are read
+    from its oldest id (ids are millisecond timestamps in every stream).
+    Returns None when the gap cannot be closed from the log: entries were
+    already trimmed, or there are more than ``limit``.
+    """
+    known = streams(PUBSUB_SHARDS)
+    if not since:
+        raise ValueError("since is empty")
+    if any(stream not in known for stream in since):
+        raise ValueError("unknown stream")
+    try:
+        floor = min((parse_id(entry_id) for entry_id in since.values()))
+    except (AttributeError, ValueError):
+        raise ValueError("invalid sequence id")
+    floor_id = f"{floor[0]}-{floor[1]}"
+
+    async with get_redis().pipeline(transaction=False) as pipe:
+        for stream in known:
+            pipe.xinfo_stream(stream)
+            pipe.xrange(stream, min="(" + since.get(stream, floor_id), max="+", count=limit + 1)
+        # XINFO fails for a stream that does not exist yet: nothing to replay there.
+        results = await pipe.execute(raise_on_error=False)
+
+    entries = []
+    for stream, info, rows in zip(known, results[::2], results[1::2]):
+        if isinstance(info, Exception) or isinstance(rows, Exception):
+            continue
+        last_seen = parse_id(since.get(stream, floor_id))
+        # Redis 7 reports the newest trimmed id; older servers only tell us
+        # the oldest kept one, which is the safe (stricter) check.
+        trimmed = info.get("max-deleted-entry-id", None)
+        if trimmed is not None:
+            if parse_id(trimmed) > last_seen:
+                return None
+        elif info.get("first-entry") and parse_id(info["first-entry"][0]) > last_seen:
+            return None
+        entries += [(stream, entry_id, fields["channel"], fields["data"]) for entry_id, fields in rows]
+
+    if len(entries) > limit:
+        return None
+    entries.sort(key=lambda entry: parse_id(entry[1]))
+    return entries
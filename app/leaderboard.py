@@ -0,0 +1,90 @@
+from app.events import EVENT_LOG_MAXLEN
+from app.metrics import REDIS_CALL_SECONDS
+from app.redis_pool import get_redis
+from app.sharding import DASH_CHANNEL, DASH_STREAM
+from project import settings
+
+LEADERBOARD_SIZE = getattr(settings, "LEADERBOARD_SIZE", 4)
+
+# Score change, top-N read, diff against the last published top, append to
+# the dashboard event stream and publish, all in one round trip and atomically. Returns the published payload, or nil
+# when the top N did not change.
+UPDATE_SCRIPT = """
+if ARGV[1] == 'add' then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+elseif ARGV[1] == 'rem' then
+    redis.call('ZREM', KEYS[1], ARGV[2])
+end
+
+local top = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[4]) - 1, 'WITHSCORES')
+local entries = {}
+for i = 1, #top, 2 do
+    entries[#entries + 1] = {top[i], tonumber(top[i + 1])}
+end
+local payload = '[]'
+if #entries > 0 then
+    payload = cjson.encode(entries)
+end
+
+if redis.call('GET', KEYS[2]) == payload then
+    return false
+end
+redis.call('SET', KEYS[2], payload)
+redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[6], '*', 'channel', ARGV[5], 'data', payload)
+redis.call('PUBLISH', ARGV[5], payload)
+return payload
+"""
+
+
+class Leaderboard:
+    def __init__(self, key: str = "dashboard", size: int = LEADERBOARD_SIZE, channel: str = DASH_CHANNEL,
+                 stream: str = DASH_STREAM):
+        self.key = key
+        self.size = size
+        self.channel = channel
+        self.stream = stream
+        self._last_key = f"{key}:top:{size}"
+        self._scripts = {}
+
+    def _script(self):
+        client = get_redis()
+        script = self._scripts.get(id(client), None)
+        if script is None:
+            script = self._scripts[id(client)] = client.register_script(UPDATE_SCRIPT)
+        return script
+
+    async def _update(self, op: str, member: str, score: float = 0) -> str | None:
+        with REDIS_CALL_SECONDS.labels("leaderboard_update").time():
+            return await self._script()(
+                keys=[self.key, self._last_key, self.stream],
+                args=[op, str(member), score, self.size, self.channel, EVENT_LOG_MAXLEN],
+            )
+
+    async def set_score(self, member: str, score: float = 0) -> str | None:
+        return await self._update("add", member, score)
+
+    async def remove(self, member: str) -> str | None:
+        return await self._update("rem", member)
+
+    async def set_scores(self, scores: dict[str, float], chunk: int = 10_000) -> str | None:
+        """Bulk ZADD, then one top-N check and publish for the whole batch."""
+        items = [(str(member), score) for member, score in scores.items()]
+        with REDIS_CALL_SECONDS.labels("leaderboard_bulk").time():
+            for offset in range(0, len(items), chunk):
+                await get_redis().zadd(self.key, dict(items[offset:offset + chunk]))
+        return await self._update("touch", "")
+
+    async def top(self) -> list[list]:
+        with REDIS_CALL_SECONDS.labels("leaderboard_top").time():
+            return await get_redis().zrevrange(self.key, 0, self.size - 1, withscores=True)
+
+    async def rank(self, member: str) -> dict:
+        with REDIS_CALL_SECONDS.labels("leaderboard_rank").time():
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.zrevrank(self.key, str(member))
+                pipe.zscore(self.key, str(member))
+                rank, score = await pipe.execute()
+        return {"rank": rank, "score": score}
+
+
+leaderboard = Leaderboard()
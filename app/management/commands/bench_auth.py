@@ -0,0 +1,72 @@
+import hashlib
+import hmac
+import json
+import time
+import uuid
+from urllib.parse import parse_qsl, urlencode
+
+from django.core.management import BaseCommand
+
+from app import utils
+
+
+def build_init_data(user: dict, auth_date: int | None = None) -> str:
+    """Telegram-style signed initData for a fake user, signed with TOKEN_BOT."""
+    fields = {
+        "auth_date": str(int(auth_date if auth_date is not None else time.time())),
+        "query_id": uuid.uuid4().hex,
+        "user": json.dumps(user, separators=(",", ":")),
+    }
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    fields["hash"] = hmac.new(utils.SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def verify_recomputing_secret(init_data: dict) -> bool:
+    # The verification as it was before the secret key was precomputed.
+    token_hash = init_data.pop("hash", None)
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(init_data.items()))
+    secret_key = hmac.new("WebAppData".encode(), utils.TOKEN_BOT.encode(), hashlib.sha256).digest()
+    calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(calculated_hash, token_hash)
+
+
+class Command(BaseCommand):
+
+    help = "measure initData verification throughput under a reconnect storm"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=5_000)
+        parser.add_argument("--reconnects", type=int, default=20,
+                            help="how many times each user re-sends the same initData")
+
+    def handle(self, *args, **options):
+        payloads = [
+            build_init_data({"id": str(uuid.uuid4()), "username": f"user{i}"})
+            for i in range(options["users"])
+        ]
+        storm = payloads * options["reconnects"]
+
+        def run_uncached():
+            utils._verified.clear()
+            for raw in storm:
+                utils._verified.clear()
+                assert utils.verify_telegram_init_data(dict(parse_qsl(raw)))
+
+        def run_cached():
+            utils._verified.clear()
+            for raw in storm:
+                assert utils.verify_telegram_init_data(dict(parse_qsl(raw)))
+
+        cases = [
+            ("secret per call", lambda: [verify_recomputing_secret(dict(parse_qsl(raw))) for raw in storm]),
+            ("precomputed secret", run_uncached),
+            ("precomputed + cache", run_cached),
+        ]
+
+        self.stdout.write(f"{len(storm)} auths from {options['users']} users")
+        for name, run in cases:
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{name:<22}{len(storm) / elapsed:>12.0f} auth/s{elapsed / len(storm) * 1e6:>10.2f} us/auth")
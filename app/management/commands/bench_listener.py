@@ -0,0 +1,106 @@
+import asyncio
+import subprocess
+import sys
+import time
+import uuid
+from urllib.request import urlopen
+
+from django.core.management import BaseCommand
+
+from app import events
+from app.redis_pool import get_redis
+from app.sharding import INVESTMENTS_CHANNEL
+
+
+def forwarded(port: int) -> int:
+    # Sum of listener_messages_total on one shard's metrics endpoint.
+    with urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as response:
+        return int(sum(
+            float(line.rsplit(" ", 1)[1])
+            for line in response.read().decode().splitlines()
+            if line.startswith("listener_messages_total")
+        ))
+
+
+class Command(BaseCommand):
+
+    help = (
+        "measure listener throughput with 1..N shard processes: publishes investment events for random "
+        "pools and reads how many each shard forwarded from its metrics endpoint. Run with PUBSUB_SHARDS "
+        "set to at least the largest process count so shards do not all read every event."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, nargs="*", default=[1, 2, 4])
+        parser.add_argument("--messages", type=int, default=100_000)
+        parser.add_argument("--pools", type=int, default=10_000)
+        parser.add_argument("--metrics-port", type=int, default=9300)
+        parser.add_argument("--timeout", type=float, default=120)
+
+    def handle(self, *args, **options):
+        pools = [str(uuid.uuid4()) for _ in range(options["pools"])]
+        baseline = None
+        for count in options["processes"]:
+            ports = [options["metrics_port"] + index for index in range(count)]
+            procs = [
+                subprocess.Popen([
+                    sys.executable, sys.argv[0], "listener",
+                    "--shard-index", str(index),
+                    "--shard-count", str(count),
+                    "--metrics-port", str(port),
+                ])
+                for index, port in enumerate(ports)
+            ]
+            try:
+                self.wait_ready(ports)
+                elapsed, total = asyncio.run(self.run(pools, options["messages"], ports, options["timeout"]))
+            finally:
+                for proc in procs:
+                    proc.terminate()
+                for proc in procs:
+                    proc.wait()
+
+            rate = total / elapsed
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{count:>3} processes {rate:>10.0f} msg/s   x{rate / baseline:4.2f}   "
+                f"forwarded {total}/{options['messages']}   duplicates {max(0, total - options['messages'])}"
+            )
+
+    @staticmethod
+    def wait_ready(ports: list[int]) -> None:
+        deadline = time.monotonic() + 30
+        for port in ports:
+            while True:
+                try:
+                    forwarded(port)
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.1)
+        # Give the shards a moment to create their consumer groups after the endpoint is up.
+        time.sleep(0.5)
+
+    @staticmethod
+    async def run(pools: list[str], messages: int, ports: list[int], timeout: float) -> tuple[float, int]:
+        redis = get_redis()
+        started = time.perf_counter()
+        for offset in range(0, messages, 1000):
+            async with redis.pipeline(transaction=False) as pipe:
+                for i in range(offset, min(offset + 1000, messages)):
+                    pool_id = pools[i % len(pools)]
+                    message = {
+                        "pool": {"id": pool_id, "curr_value": i},
+                        "investment": {"user_id": str(uuid.uuid4()), "pool_id": pool_id, "input": 1},
+                    }
+                    events.queue(pipe, INVESTMENTS_CHANNEL, message)
+                await pipe.execute()
+
+        total = 0
+        while time.perf_counter() - started < timeout:
+            total = sum(await asyncio.gather(*(asyncio.to_thread(forwarded, port) for port in ports)))
+            if total >= messages:
+                break
+            await asyncio.sleep(0.05)
+        return time.perf_counter() - started, total
@@ -0,0 +1,113 @@
+import random
+import statistics
+import time
+import uuid
+from decimal import Decimal
+from logging import getLogger
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from app.models import TradePool, TradeInvestment
+
+logger = getLogger("bench_queries.py")
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+
+    help = "seed investments inside a rolled-back transaction and time the consumer queries with and without indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--investments", type=int, default=1_000_000)
+        parser.add_argument("--pools", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        # Everything, including the dropped indexes, is rolled back at the end.
+        # The seed still locks the tables while it runs: use a dev database.
+        try:
+            with transaction.atomic():
+                self.seed(options["pools"], options["investments"])
+                self.report("with indexes", options["repeat"])
+                self.drop_indexes()
+                self.report("without indexes", options["repeat"])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, n_pools: int, n_invs: int) -> None:
+        started = time.perf_counter()
+        pools = [
+            TradePool(
+                user_id=uuid.uuid4(), active="BTC", is_long=bool(i % 2), is_order=False,
+                order=Decimal("100"), final_amount=Decimal("1000"), stop_loss=10, take_profit=10,
+                leverage=Decimal("1"), curr_value=Decimal(random.randint(0, 10_000_000)) / 100,
+            )
+            for i in range(n_pools)
+        ]
+        TradePool.objects.bulk_create(pools, batch_size=10_000)
+
+        self.pool_ids = [p.id for p in pools]
+        self.keys = []
+        batch = []
+        for _ in range(n_invs):
+            key = (uuid.uuid4(), random.choice(self.pool_ids))
+            self.keys.append(key)
+            batch.append(TradeInvestment(user_id=key[0], pool_id=key[1], input=Decimal("10")))
+            if len(batch) == 10_000:
+                TradeInvestment.objects.bulk_create(batch)
+                batch = []
+        TradeInvestment.objects.bulk_create(batch)
+
+        self.analyze()
+        self.stdout.write(f"seeded {n_pools} pools, {n_invs} investments in {time.perf_counter() - started:.1f}s")
+
+    def drop_indexes(self) -> None:
+        with connection.schema_editor() as editor:
+            for model in (TradePool, TradeInvestment):
+                for index in model._meta.indexes:
+                    editor.remove_index(model, index)
+                for constraint in model._meta.constraints:
+                    editor.remove_constraint(model, constraint)
+        self.analyze()
+
+    @staticmethod
+    def analyze() -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {TradePool._meta.db_table}")
+            cursor.execute(f"ANALYZE {TradeInvestment._meta.db_table}")
+
+    def inv_lookup(self) -> bool:
+        user_id, pool_id = random.choice(self.keys)
+        return TradeInvestment.objects.filter(user_id=user_id, pool_id=pool_id).exists()
+
+    def report(self, label: str, repeat: int) -> None:
+        cases = {
+            "inv by (user_id, pool_id)": self.inv_lookup,
+            "inv by pool_id": lambda: list(TradeInvestment.objects.filter(
+                pool_id=random.choice(self.pool_ids)).values_list("id", flat=True)),
+            "pools by curr_value": lambda: list(TradePool.objects.order_by("curr_value").values_list(
+                "id", "user_id", "active", "is_long", "is_order", "order", "final_amount",
+                "stop_loss", "take_profit", "leverage", "curr_value", "in_amount")),
+            "inv delta page": lambda: list(TradeInvestment.objects.order_by("updated_at", "id").values_list(
+                "id", flat=True)[:500]),
+        }
+
+        self.stdout.write(f"-- {label}")
+        for name, run in cases.items():
+            # The full pool listing is much heavier than the point lookups.
+            n = max(5, repeat // 20) if name == "pools by curr_value" else repeat
+            timings = []
+            for _ in range(n):
+                started = time.perf_counter()
+                run()
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f"{name:<28} p50 {statistics.median(timings):8.2f} ms   "
+                f"p99 {timings[min(len(timings) - 1, int(len(timings) * 0.99))]:8.2f} ms"
+            )
@@ -0,0 +1,70 @@
+import json
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from app.models import TradePool, TradeInvestment
+from app.serializers import TradePoolSerializer, TradeInvestmentSerializer, trade_pool_fast, trade_investment_fast
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+
+    help = "compare ModelSerializer(many=True) with the FastSerializer path on seeded rows (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="*", default=[10_000, 100_000])
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                seeded = 0
+                for rows in sorted(options["rows"]):
+                    self.seed(rows - seeded)
+                    seeded = rows
+                    self.compare(rows)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    @staticmethod
+    def seed(n: int) -> None:
+        pools = [
+            TradePool(
+                user_id=uuid.uuid4(), active="BTC", is_long=bool(i % 2), is_order=False,
+                order=Decimal("65000.1234567891"), final_amount=Decimal("1000.5"), stop_loss=10,
+                take_profit=10, leverage=Decimal("2"), curr_value=Decimal(i) / 7, in_amount=i,
+            )
+            for i in range(n)
+        ]
+        TradePool.objects.bulk_create(pools, batch_size=10_000)
+        TradeInvestment.objects.bulk_create([
+            TradeInvestment(user_id=uuid.uuid4(), pool_id=pool.id, input=Decimal("12.3"))
+            for pool in pools
+        ], batch_size=10_000)
+
+    def compare(self, rows: int) -> None:
+        cases = [
+            ("pools", TradePool.objects.order_by("curr_value", "id"), TradePoolSerializer, trade_pool_fast),
+            ("investments", TradeInvestment.objects.order_by("id"), TradeInvestmentSerializer, trade_investment_fast),
+        ]
+        for name, queryset, serializer_class, fast in cases:
+            started = time.perf_counter()
+            slow_data = serializer_class(queryset, many=True).data
+            slow = time.perf_counter() - started
+
+            started = time.perf_counter()
+            fast_data = fast.serialize(queryset)
+            quick = time.perf_counter() - started
+
+            identical = json.dumps(slow_data) == json.dumps(fast_data)
+            self.stdout.write(
+                f"{rows:>8} {name:<12} ModelSerializer {slow * 1000:9.1f} ms   "
+                f"fast {quick * 1000:9.1f} ms   x{slow / quick:5.1f}   identical: {identical}"
+            )
@@ -0,0 +1,98 @@
+import json
+import random
+import time
+import uuid
+import zlib
+
+from django.core.management import BaseCommand
+
+from app.broadcast import empty_tick, add_event, encode_tick
+from app.wire import JSON, MSGPACK, pack
+
+
+def fake_pool() -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "active": random.choice(["BTC", "ETH", "TON"]),
+        "is_long": random.random() < 0.5,
+        "is_order": False,
+        "order": f"{random.uniform(1, 70000):.10f}",
+        "final_amount": f"{random.uniform(10, 10000):.2f}",
+        "stop_loss": random.randint(1, 90),
+        "take_profit": random.randint(1, 500),
+        "leverage": f"{random.choice([1, 2, 5, 10, 25]):.2f}",
+        "curr_value": f"{random.uniform(0, 100000):.2f}",
+        "in_amount": random.randint(0, 1000),
+    }
+
+
+def fake_inv(pool: dict) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "pool_id": pool["id"],
+        "input": f"{random.uniform(1, 1000):.2f}",
+    }
+
+
+class Command(BaseCommand):
+
+    help = "compare encode CPU and frame size of the wire formats for auth snapshots and tick broadcasts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pools", type=int, default=10_000)
+        parser.add_argument("--investments", type=int, default=50_000)
+        parser.add_argument("--tick-updates", type=int, default=200)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--levels", type=int, nargs="*", default=[1, 6, 9],
+                            help="zlib levels to measure compression at")
+
+    def handle(self, *args, **options):
+        pools = [fake_pool() for _ in range(options["pools"])]
+        invs = [fake_inv(random.choice(pools)) for _ in range(options["investments"])]
+        snapshot = {"type": "auth", "data": {"user": None, "pools": pools, "invs": invs, "dash": []}}
+
+        tick = empty_tick()
+        for _ in range(options["tick_updates"]):
+            pool = random.choice(pools)
+            add_event(tick, {
+                "pool": {"id": pool["id"], "curr_value": pool["curr_value"], "in_amount": pool["in_amount"]},
+                "investment": {"user_id": str(uuid.uuid4()), "pool_id": pool["id"], "amount": "10.00"},
+            })
+
+        cases = [
+            ("auth snapshot", "json", lambda: json.dumps(snapshot).encode()),
+            ("auth snapshot", "msgpack", lambda: pack(snapshot)),
+            ("tick", "json", lambda: encode_tick(tick, JSON).encode()),
+            ("tick", "msgpack", lambda: encode_tick(tick, MSGPACK)),
+        ]
+        self.report(cases, options["repeat"])
+        self.report_compression(cases, options["levels"], options["repeat"])
+
+    @staticmethod
+    def timed(run, repeat: int) -> float:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        return (time.perf_counter() - started) / repeat * 1000
+
+    def report(self, cases: list, repeat: int) -> None:
+        self.stdout.write(f"{'frame':<16}{'format':<14}{'bytes':>12}{'encode ms':>12}")
+        for frame, fmt, run in cases:
+            data = run()
+            elapsed = self.timed(run, repeat)
+            self.stdout.write(f"{frame:<16}{fmt:<14}{len(data):>12}{elapsed:>12.3f}")
+
+    def report_compression(self, cases: list, levels: list[int], repeat: int) -> None:
+        self.stdout.write("")
+        self.stdout.write(f"{'frame':<16}{'format':<14}{'level':>6}{'bytes':>12}{'ratio':>8}{'zlib ms':>10}")
+        for frame, fmt, run in cases:
+            data = run()
+            for level in levels:
+                compressed = zlib.compress(data, level)
+                elapsed = self.timed(lambda: zlib.compress(data, level), repeat)
+                self.stdout.write(
+                    f"{frame:<16}{fmt:<14}{level:>6}{len(compressed):>12}"
+                    f"{len(data) / len(compressed):>8.2f}{elapsed:>10.3f}"
+                )
@@ -1,43 +1,284 @@
-import traceback
+import asyncio
+import json
+import subprocess
+import sys
+import time
 from logging import getLogger
 
-import redis
-from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.core.management import BaseCommand
+from redis.exceptions import ResponseError
+
+from app.broadcast import BROADCAST_TICK, TickScheduler
+from app.events import LISTENER_GROUP, encode_frame, event_id, message_type, pack_frame
+from app.metrics import LISTENER_LAG_SECONDS, LISTENER_MESSAGES, METRICS_PORT, start_server
+from app.redis_pool import PUBSUB_SHARDS, get_redis
+from app.sharding import listener_streams, routing_key, shard_of
+from app.topics import event_groups
+from app.wire import MSGPACK, WIRE_FORMATS, broadcast_frames
+from project import settings
 
 logger = getLogger("listener.py")
 
+LISTENER_WORKERS = getattr(settings, "LISTENER_WORKERS", 8)
+LISTENER_QUEUE_SIZE = getattr(settings, "LISTENER_QUEUE_SIZE", 1000)
+LISTENER_READ_COUNT = getattr(settings, "LISTENER_READ_COUNT", 500)
+LISTENER_CLAIM_IDLE = getattr(settings, "LISTENER_CLAIM_IDLE", 30.0)
+
+
+class Listener:
+    """
+    Forwards the event streams (see ``app.events``) to the channel-layer
+    groups that subscribe to them (``main`` plus the topic groups from
+    ``app.topics``).
+
+    Entries are read through a consumer group and acknowledged once they
+    were sent (with a tick: once the tick carrying them was sent), so a
+    restarted listener first re-sends what it had read but not delivered
+    and then continues where it stopped; nothing published while it was
+    down is lost. Entries whose send failed stay pending the same way and
+    are claimed back and re-sent once they sat unacked for ``claim_idle``
+    seconds (an entry that is only slow may then go out twice; sockets drop
+    the copy by its event id).
+
+    Every pool is pinned to one worker queue by a stable hash of its id, so
+    the events of one pool stay in order while different pools are sent
+    concurrently. The queues are bounded: when the workers fall behind, the
+    reader stops pulling from Redis instead of buffering without limit.
+    With ``shard_count`` > 1 each process only forwards the pools that hash to
+    its ``shard_index`` (the dashboard goes to shard 0), so N processes never
+    deliver twice. With ``PUBSUB_SHARDS`` > 1 that split already happens in
+    Redis: each process only reads its own stream shards.
+    With a ``tick`` interval, pool and investment events are coalesced by a
+    TickScheduler instead of being sent one by one.
+    """
+
+    def __init__(self, workers: int = LISTENER_WORKERS, queue_size: int = LISTENER_QUEUE_SIZE,
+                 shard_index: int = 0, shard_count: int = 1, tick: float = BROADCAST_TICK,
+                 metrics_port: int | None = METRICS_PORT, pubsub_shards: int = PUBSUB_SHARDS,
+                 claim_idle: float = LISTENER_CLAIM_IDLE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.tick = tick
+        self.metrics_port = metrics_port
+        self.pubsub_shards = pubsub_shards
+        self.claim_idle = claim_idle
+        self.scheduler = None
+        # One group per shard: with a single shared stream every shard has
+        # to see every entry (and keep its own pools).
+        self.group = f"{LISTENER_GROUP}.{shard_index}"
+        self.consumer = LISTENER_GROUP
+        self._acks: dict[str, list[str]] = {}
+
+    async def run(self) -> None:
+        await start_server(self.metrics_port)
+        self.channel_layer = get_channel_layer()
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        workers = [asyncio.create_task(self.worker(queue)) for queue in self.queues]
+        if self.tick > 0:
+            self.scheduler = TickScheduler(self.channel_layer, self.tick, on_sent=lambda msgs: self.ack(*msgs))
+            workers.append(asyncio.create_task(self.scheduler.run()))
+
+        streams = listener_streams(self.shard_index, self.shard_count, self.pubsub_shards)
+        try:
+            backoff = 0.5
+            while True:
+                try:
+                    redis = get_redis()
+                    for stream in streams:
+                        await self.create_group(redis, stream)
+                    logger.info(f"reading {', '.join(streams)} as {self.group} "
+                                f"(shard {self.shard_index}/{self.shard_count})")
+                    backoff = 0.5
+
+                    # "0": own entries read before a restart and never acked; ">": new ones.
+                    positions = {stream: "0" for stream in streams}
+                    claimed = time.monotonic()
+                    while True:
+                        await self.flush_acks(redis)
+                        if time.monotonic() - claimed >= self.claim_idle:
+                            claimed = time.monotonic()
+                            for stream in streams:
+                                await self.reclaim(redis, stream)
+                        response = await redis.xreadgroup(
+                            self.group, self.consumer, positions, count=LISTENER_READ_COUNT, block=1000,
+                        )
+                        pending = {stream for stream, position in positions.items() if position != ">"}
+                        for stream, entries in response or []:
+                            for entry_id, fields in entries:
+                                await self.route({"stream": stream, "id": entry_id, **fields})
+                            if stream in pending and entries:
+                                positions[stream] = entries[-1][0]
+                                pending.discard(stream)
+                        # A pending read that came back empty is drained.
+                        for stream in pending:
+                            positions[stream] = ">"
+
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    logger.exception(f"redis connection lost, reconnecting in {backoff}s: {ex}")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def create_group(self, redis, stream: str) -> None:
+        try:
+            await redis.xgroup_create(stream, self.group, id="$", mkstream=True)
+        except ResponseError as ex:
+            if "BUSYGROUP" not in str(ex):
+                raise
+
+    async def reclaim(self, redis, stream: str) -> None:
+        """Re-route the entries of ``stream`` left unacked for at least ``claim_idle`` seconds."""
+        start = "0-0"
+        while True:
+            start, entries, *_ = await redis.xautoclaim(
+                stream, self.group, self.consumer, int(self.claim_idle * 1000),
+                start_id=start, count=LISTENER_READ_COUNT,
+            )
+            for entry_id, fields in entries:
+                if fields:
+                    await self.route({"stream": stream, "id": entry_id, **fields})
+            if start == "0-0":
+                return
+
+    def ack(self, *msgs: dict) -> None:
+        for msg in msgs:
+            self._acks.setdefault(msg["stream"], []).append(msg["id"])
+
+    async def flush_acks(self, redis) -> None:
+        acks, self._acks = self._acks, {}
+        for stream, ids in acks.items():
+            await redis.xack(stream, self.group, *ids)
+
+    async def route(self, msg: dict) -> None:
+        try:
+            data = json.loads(msg["data"])
+        except ValueError as ex:
+            logger.error(f"dropping malformed entry {msg['id']} on {msg['stream']}: {ex}")
+            self.ack(msg)
+            return
+        key = routing_key(data)
+        owner = 0 if key is None else shard_of(key, self.shard_count)
+        if self.pubsub_shards <= 1 and owner != self.shard_index:
+            self.ack(msg)
+            return
+        await self.queues[shard_of(key, self.workers * self.shard_count) // self.shard_count].put((msg, data))
+
+    async def worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            msg, data = await queue.get()
+            try:
+                await self.forward(msg, data)
+            finally:
+                queue.task_done()
+
+    async def forward(self, msg: dict, data) -> None:
+        try:
+            m_type = message_type(msg["channel"])
+            groups = event_groups(m_type, data)
+            seq = {msg["stream"]: msg["id"]}
+            # Lets a socket in several of the groups keep only one copy.
+            eid = event_id(msg["stream"], msg["id"])
+
+            LISTENER_MESSAGES.labels(m_type).inc()
+
+            if self.scheduler is not None and m_type != "dash":
+                # Acked by the scheduler once the tick is out. Lag here is
+                # only up to the hand-off; the tick adds at most one interval.
+                self.scheduler.add(groups, data, seq, msg, eid)
+                self.observe_lag(m_type, msg)
+                return
+
+            event = {
+                "type": m_type,
+                "key": "dash" if m_type == "dash" else None,
+                **broadcast_frames(
+                    encode_frame(m_type, msg["data"], data, seq),
+                    pack_frame(m_type, data, seq) if MSGPACK in WIRE_FORMATS else None,
+                ),
+                "ids": [eid],
+                "ts": time.time(),
+            }
+        except Exception as ex:
+            # Would fail again on every retry.
+            logger.exception(f"dropping entry {msg['id']} on {msg['stream']}: {ex}")
+            self.ack(msg)
+            return
+
+        results = await asyncio.gather(
+            *(self.channel_layer.group_send(group, event) for group in groups), return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            logger.error(f"sending {msg['id']} on {msg['stream']} failed, left pending: {errors[0]!r}")
+            return
+        self.observe_lag(m_type, msg)
+        self.ack(msg)
+
+    @staticmethod
+    def observe_lag(m_type: str, msg: dict) -> None:
+        # events.queue stamps "ts" (wall clock) on the stream entry; the
+        # leaderboard script does not.
+        if "ts" in msg:
+            LISTENER_LAG_SECONDS.labels(m_type).observe(time.time() - float(msg["ts"]))
+
+
 class Command(BaseCommand):
 
     help = "start listener.py"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=LISTENER_WORKERS)
+        parser.add_argument("--queue-size", type=int, default=LISTENER_QUEUE_SIZE)
+        parser.add_argument("--processes", type=int, default=1,
+                            help="spawn this many shard processes and wait for them")
+        parser.add_argument("--shard-index", type=int, default=0)
+        parser.add_argument("--shard-count", type=int, default=1)
+        parser.add_argument("--tick", type=float, default=BROADCAST_TICK,
+                            help="batch pool/investment events into one frame every TICK seconds (0 = off)")
+        parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                            help="serve metrics on this port (shard processes use port + shard index)")
+
     def handle(self, *args, **options):
+        if options["processes"] > 1:
+            return self.spawn(options)
+
+        listener = Listener(
+            workers=options["workers"],
+            queue_size=options["queue_size"],
+            shard_index=options["shard_index"],
+            shard_count=options["shard_count"],
+            tick=options["tick"],
+            metrics_port=options["metrics_port"],
+        )
         try:
-            r = redis.Redis(host='localhost', port=6379, decode_responses=True)
-            p = r.pubsub()
-            p.psubscribe("main.*")
-            channel_layer = get_channel_layer()
-            for msg in p.listen():
-                logger.debug(msg)
-                if msg["type"] == "pmessage":
-                    m_channel = msg["channel"]
-                    if "dash" in m_channel:
-                        m_type = "dash"
-                    # elif "update" in m_channel:
-                    #     m_type = "update_pool"
-                    elif "pool" in m_channel:
-                        m_type = "pool"
-                    else:
-                        m_type = "investment"
-
-                    async_to_sync(channel_layer.group_send)(
-                        "main",
-                        {
-                            "type": m_type,
-                            "data": msg["data"]
-                        }
-                    )
-        except Exception as ex:
-            logger.exception(ex)
-            logger.exception(traceback.format_exc())
\ No newline at end of file
+            asyncio.run(listener.run())
+        except KeyboardInterrupt:
+            pass
+
+    def spawn(self, options: dict) -> None:
+        count = options["processes"]
+        procs = [
+            subprocess.Popen([
+                sys.executable, sys.argv[0], "listener",
+                "--workers", str(options["workers"]),
+                "--queue-size", str(options["queue_size"]),
+                "--shard-index", str(index),
+                "--shard-count", str(count),
+                "--tick", str(options["tick"]),
+                *(["--metrics-port", str(options["metrics_port"] + index)] if options["metrics_port"] else []),
+            ])
+            for index in range(count)
+        ]
+        try:
+            for proc in procs:
+                proc.wait()
+        except KeyboardInterrupt:
+            for proc in procs:
+                proc.terminate()
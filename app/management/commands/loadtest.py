@@ -0,0 +1,248 @@
+import json
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import websocket
+from django.core.management import BaseCommand, CommandError
+
+from app.management.commands.bench_auth import build_init_data
+
+DEFAULT_URL = "ws://127.0.0.1:8000/ws/telegram/main/"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def rss_bytes(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency: dict[str, list[float]] = {}
+        self.received = 0
+        self.received_bytes = 0
+        self.sent = 0
+        self.errors = 0
+
+    def observe(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.latency.setdefault(phase, []).append(seconds)
+
+    def frame(self, size: int) -> None:
+        with self.lock:
+            self.received += 1
+            self.received_bytes += size
+
+
+class Client:
+    """
+    One simulated user: a socket plus a reader thread that matches replies
+    and broadcasts back to the requests that caused them.
+    """
+
+    def __init__(self, url: str, stats: Stats, timeout: float):
+        self.url = url
+        self.stats = stats
+        self.timeout = timeout
+        self.user_id = str(uuid.uuid4())
+        self.pool: dict | None = None
+        self.ws: websocket.WebSocket | None = None
+
+        self._authed = threading.Event()
+        self._pooled = threading.Event()
+        self._pending: dict[int, float] = {}
+        self.updates = 0
+        self._lock = threading.Lock()
+
+    def connect(self) -> None:
+        started = time.perf_counter()
+        self.ws = websocket.create_connection(self.url, timeout=self.timeout)
+        self.stats.observe("connect", time.perf_counter() - started)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def close(self) -> None:
+        if self.ws is not None:
+            self.ws.close()
+
+    def send(self, m_type: str, action: str, params: dict) -> None:
+        with self._lock:
+            self.ws.send(json.dumps({"type": m_type, "action": action, "params": params}))
+        with self.stats.lock:
+            self.stats.sent += 1
+
+    def _read(self) -> None:
+        while True:
+            try:
+                frame = self.ws.recv()
+            except Exception:
+                return
+            if not frame:
+                return
+            self.stats.frame(len(frame))
+            try:
+                self._handle(json.loads(frame))
+            except Exception:
+                with self.stats.lock:
+                    self.stats.errors += 1
+
+    def _handle(self, message: dict) -> None:
+        m_type = message.get("type", None)
+        data = message.get("data", None)
+        if m_type == "auth":
+            self._authed.set()
+        elif m_type == "error":
+            with self.stats.lock:
+                self.stats.errors += 1
+        elif m_type == "pool":
+            self._own_pool(data)
+        elif m_type == "investment":
+            self._echo(data.get("investment", None))
+        elif m_type == "tick":
+            # With BROADCAST_TICK on the created pool only arrives in a tick.
+            for pool in data.get("pools", []):
+                self._own_pool(pool)
+            for inv in data.get("investments", []):
+                self._echo(inv)
+
+    def _own_pool(self, pool: dict) -> None:
+        if pool.get("user_id", None) == self.user_id and self.pool is None:
+            self.pool = pool
+            self._pooled.set()
+
+    def _echo(self, inv: dict | None) -> None:
+        if not inv or inv.get("user_id", None) != self.user_id:
+            return
+        sent = self._pending.pop(inv.get("seq", None), None)
+        if sent is not None:
+            self.stats.observe("update", time.perf_counter() - sent)
+
+    def auth(self) -> bool:
+        started = time.perf_counter()
+        self.send("user", "auth", {
+            "init_data": build_init_data({"id": self.user_id, "username": f"load-{self.user_id[:8]}"}),
+        })
+        if not self._authed.wait(self.timeout):
+            return False
+        self.stats.observe("auth", time.perf_counter() - started)
+        return True
+
+    def create_pool(self) -> bool:
+        started = time.perf_counter()
+        self.send("trade_pool", "create", {
+            "user_id": self.user_id, "active": "BTC", "is_long": True, "is_order": False, "order": None,
+            "final_amount": "1000.00", "stop_loss": 10, "take_profit": 10, "leverage": "2.00",
+        })
+        if not self._pooled.wait(self.timeout):
+            return False
+        self.stats.observe("pool_create", time.perf_counter() - started)
+        return True
+
+    def update(self) -> None:
+        # "seq" rides along in the investment so the echo can be matched;
+        # the server passes it through untouched.
+        self.updates += 1
+        self._pending[self.updates] = time.perf_counter()
+        self.send("trade_pool", "update", {
+            "pool": {"id": self.pool["id"], "curr_value": self.updates, "in_amount": self.updates},
+            "investment": {"user_id": self.user_id, "pool_id": self.pool["id"], "input": 1, "amount": 1,
+                           "seq": self.updates},
+        })
+
+    def run_updates(self, rate: float, until: float) -> None:
+        interval = 1 / rate
+        next_at = time.perf_counter()
+        while next_at < until:
+            self.update()
+            next_at += interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class Command(BaseCommand):
+
+    help = (
+        "load-test ws/telegram/main/: N clients connect, auth in a burst, create a pool each and send "
+        "trade_pool/update at a fixed rate; reports p50/p99 latency, messages/s and memory per connection. "
+        "Needs a running server (daphne project.asgi:application), Postgres, Redis and the listener command."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default=DEFAULT_URL)
+        parser.add_argument("--clients", type=int, default=100)
+        parser.add_argument("--rate", type=float, default=5,
+                            help="trade_pool/update messages per client per second")
+        parser.add_argument("--duration", type=float, default=10, help="seconds of update traffic")
+        parser.add_argument("--timeout", type=float, default=10)
+        parser.add_argument("--server-pid", type=int, default=None,
+                            help="server process to sample RSS from for memory per connection")
+
+    def handle(self, *args, **options):
+        stats = Stats()
+        count = options["clients"]
+        clients = [Client(options["url"], stats, options["timeout"]) for _ in range(count)]
+        pid = options["server_pid"]
+        rss_before = rss_bytes(pid) if pid else None
+
+        with ThreadPoolExecutor(max_workers=min(count, 256)) as pool:
+            try:
+                list(pool.map(lambda c: c.connect(), clients))
+            except Exception as ex:
+                raise CommandError(f"connect failed: {ex}")
+
+            authed = sum(pool.map(lambda c: c.auth(), clients))
+            rss_after = rss_bytes(pid) if pid else None
+            pooled = sum(pool.map(lambda c: c.create_pool(), clients))
+
+        active = [c for c in clients if c.pool is not None]
+        received_before, bytes_before = stats.received, stats.received_bytes
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=c.run_updates, args=(options["rate"], started + options["duration"]))
+            for c in active
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Let in-flight echoes arrive before reporting.
+        time.sleep(min(options["timeout"], 1.0))
+        elapsed = time.perf_counter() - started
+
+        for client in clients:
+            client.close()
+
+        self.stdout.write(f"clients {count}   authed {authed}   pools {pooled}   errors {stats.errors}")
+        for phase in ("connect", "auth", "pool_create", "update"):
+            values = stats.latency.get(phase, [])
+            if values:
+                self.stdout.write(
+                    f"{phase:<12}{len(values):>8}   p50 {percentile(values, 0.5) * 1000:8.1f} ms   "
+                    f"p99 {percentile(values, 0.99) * 1000:8.1f} ms   "
+                    f"mean {statistics.fmean(values) * 1000:8.1f} ms"
+                )
+        sent = sum(c.updates for c in active)
+        lost = sent - len(stats.latency.get("update", []))
+        self.stdout.write(
+            f"sent {sent / options['duration']:.0f} msg/s   "
+            f"received {(stats.received - received_before) / elapsed:.0f} msg/s   "
+            f"{(stats.received_bytes - bytes_before) / elapsed / 1024:.0f} KiB/s   unmatched updates {lost}"
+        )
+        if rss_before is not None and rss_after is not None:
+            self.stdout.write(f"server memory per connection {(rss_after - rss_before) / count / 1024:.1f} KiB")
@@ -0,0 +1,41 @@
+import asyncio
+import math
+import random
+
+from django.core.management import BaseCommand
+
+from app.redis_pool import get_redis
+from app.valuation import PRICES_CHANNEL
+
+
+class Command(BaseCommand):
+
+    help = "stand-in price feed: publishes a random walk per asset on prices.<ASSET>"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--assets", nargs="*", default=["BTC=65000", "ETH=3500", "TON=7"],
+                            help="ASSET=START_PRICE pairs")
+        parser.add_argument("--interval", type=float, default=0.1, help="seconds between price updates")
+        parser.add_argument("--volatility", type=float, default=0.001,
+                            help="standard deviation of the log return per update")
+
+    def handle(self, *args, **options):
+        prices = {}
+        for item in options["assets"]:
+            asset, _, start = item.partition("=")
+            prices[asset] = float(start or 100)
+        try:
+            asyncio.run(self.run(prices, options["interval"], options["volatility"]))
+        except KeyboardInterrupt:
+            pass
+
+    @staticmethod
+    async def run(prices: dict[str, float], interval: float, volatility: float) -> None:
+        redis = get_redis()
+        while True:
+            async with redis.pipeline(transaction=False) as pipe:
+                for asset, price in prices.items():
+                    prices[asset] = price = price * math.exp(random.gauss(0, volatility))
+                    pipe.publish(f"{PRICES_CHANNEL}.{asset}", f"{price:.10f}")
+                await pipe.execute()
+            await asyncio.sleep(interval)
@@ -0,0 +1,30 @@
+import asyncio
+from logging import getLogger
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from app.leaderboard import leaderboard
+from app.models import TelegramUser, TradePool
+
+logger = getLogger("rebuild_aggregates.py")
+
+
+class Command(BaseCommand):
+
+    help = "recompute pool and user aggregates (totals, investor counts, pnl) and reload the leaderboard"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--skip-leaderboard", action="store_true")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            pools = TradePool.objects.rebuild()
+            users = TelegramUser.objects.rebuild()
+
+        if not options["skip_leaderboard"]:
+            scores = {str(pk): pnl for pk, pnl in TelegramUser.objects.values_list("id", "pnl").iterator()}
+            asyncio.run(leaderboard.set_scores(scores))
+
+        logger.info(f"rebuilt aggregates for {pools} pools and {users} users")
+        self.stdout.write(f"rebuilt aggregates for {pools} pools and {users} users")
@@ -0,0 +1,19 @@
+import asyncio
+
+from django.core.management import BaseCommand
+
+from app.valuation import VALUATION_TICK, ValuationEngine
+
+
+class Command(BaseCommand):
+
+    help = "value open pools from prices.<ASSET> once per tick (one DB update and one publish per tick)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tick", type=float, default=VALUATION_TICK)
+
+    def handle(self, *args, **options):
+        try:
+            asyncio.run(ValuationEngine(tick=options["tick"]).run())
+        except KeyboardInterrupt:
+            pass
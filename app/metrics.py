@@ -0,0 +1,237 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Kept dependency-free: a handful of counters, gauges and histograms guarded by
+one lock (they are also updated from DB executor threads), rendered by a tiny
+asyncio HTTP server on ``METRICS_PORT``.
+"""
+import asyncio
+import bisect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from project import settings
+
+logger = logging.getLogger("metrics")
+
+METRICS_HOST = getattr(settings, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(settings, "METRICS_PORT", None)
+LOG_SAMPLE_RATE = getattr(settings, "LOG_SAMPLE_RATE", 0.001)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_lock = threading.Lock()
+_metrics: list["Metric"] = []
+
+
+def sampled(rate: float = LOG_SAMPLE_RATE) -> bool:
+    """True for roughly ``rate`` of calls; used to sample payload logging."""
+    return rate > 0 and random.random() < rate
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children: dict[tuple, object] = {}
+        _metrics.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values, None)
+        if child is None:
+            with _lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines += child.render(self.name, _labels(self.label_names, values))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        with _lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with _lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def render(self, name: str, labels: str) -> list[str]:
+        return [f"{name}{labels} {self.value}"]
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        with _lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self, name: str, labels: str) -> list[str]:
+        inner = labels[1:-1] + "," if labels else ""
+        lines, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{inner}le="{bound}"}} {total}')
+        total += self.counts[-1]
+        lines.append(f'{name}_bucket{{{inner}le="+Inf"}} {total}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {total}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), fn: Callable[[], float] | None = None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def render(self) -> list[str]:
+        if self.fn is not None:
+            try:
+                self.set(self.fn())
+            except Exception as ex:
+                logger.debug(f"gauge {self.name} failed: {ex}")
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, help, labels)
+
+    def _child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except Exception as ex:
+        logger.debug(f"metrics request failed: {ex}")
+    finally:
+        writer.close()
+
+
+_server: asyncio.AbstractServer | None = None
+_server_tried = False
+
+
+async def start_server(port: int | None = METRICS_PORT, host: str = METRICS_HOST) -> None:
+    """Start the scrape endpoint once per process; a busy port is only logged."""
+    global _server, _server_tried
+    if _server_tried or not port:
+        return
+    _server_tried = True
+    try:
+        _server = await asyncio.start_server(_handle, host, port)
+        logger.info(f"metrics on http://{host}:{port}/metrics")
+    except OSError as ex:
+        logger.warning(f"metrics endpoint not started on {host}:{port}: {ex}")
+
+
+# Consumers
+WS_CONNECTIONS = Gauge("ws_connections", "Open WebSocket connections")
+WS_BYTES_SENT = Counter("ws_bytes_sent_total", "Bytes sent to WebSocket clients", ("kind",))
+WS_FRAMES_SENT = Counter("ws_frames_sent_total", "Frames sent to WebSocket clients", ("kind",))
+WS_HANDLER_SECONDS = Histogram("ws_handler_seconds", "PoolConsumer.receive handler latency", ("action",))
+WS_HANDLER_ERRORS = Counter("ws_handler_errors_total", "Messages rejected or failed", ("code",))
+WS_DELIVERY_LAG_SECONDS = Histogram("ws_delivery_lag_seconds", "group_send to consumer handler delay", ("type",))
+OUTBOX_QUEUED = Gauge("outbox_frames_queued", "Frames waiting in all outboxes")
+OUTBOX_DROPPED = Counter("outbox_dropped_total", "Outbox frames dropped before they were sent", ("reason",))
+OUTBOX_OVERFLOWS = Counter("outbox_overflows_total", "Outboxes over the high watermark", ("action",))
+OUTBOX_SEND_SECONDS = Histogram("outbox_send_seconds", "Time to hand one frame to the transport")
+OUTBOX_UNACKED = Histogram("outbox_unacked_frames", "Frames sent but not yet received, at each client ack",
+                           buckets=(1, 10, 50, 100, 250, 500, 1000, 2000, 5000))
+
+# Backends
+DB_QUEUE_WAIT_SECONDS = Histogram("db_queue_wait_seconds", "Wait for a database_sync_to_async worker thread")
+DB_CALL_SECONDS = Histogram("db_call_seconds", "Time spent in database_sync_to_async functions", ("func",))
+REDIS_CALL_SECONDS = Histogram("redis_call_seconds", "Redis call latency", ("op",))
+
+# Listener
+LISTENER_LAG_SECONDS = Histogram("listener_lag_seconds", "Publish to group_send delay", ("type",))
+LISTENER_MESSAGES = Counter("listener_messages_total", "Pub/sub messages forwarded", ("type",))
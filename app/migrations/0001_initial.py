@@ -0,0 +1,74 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:17
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramUser',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('username', models.CharField(max_length=150, null=True, unique=True)),
+                ('pnl', models.IntegerField(default=0)),
+                ('img', models.CharField(max_length=300, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'telegram user',
+                'verbose_name_plural': 'telegram users',
+                'db_table': 'test_telegram_user',
+                'get_latest_by': 'updated_at',
+            },
+        ),
+        migrations.CreateModel(
+            name='TradeInvestment',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('user_id', models.UUIDField(editable=False)),
+                ('pool_id', models.UUIDField(editable=False)),
+                ('input', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'trade investment',
+                'verbose_name_plural': 'trade investments',
+                'db_table': 'test_trade_investment',
+                'get_latest_by': 'updated_at',
+            },
+        ),
+        migrations.CreateModel(
+            name='TradePool',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('user_id', models.UUIDField(editable=False, unique=True)),
+                ('active', models.CharField(max_length=10)),
+                ('is_long', models.BooleanField(verbose_name='is long')),
+                ('is_order', models.BooleanField(verbose_name='is order')),
+                ('order', models.DecimalField(decimal_places=10, max_digits=20, null=True)),
+                ('final_amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='final amount')),
+                ('stop_loss', models.SmallIntegerField(verbose_name='stop loss')),
+                ('take_profit', models.PositiveIntegerField(verbose_name='take profit')),
+                ('leverage', models.DecimalField(decimal_places=2, max_digits=5)),
+                ('curr_value', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='curr value')),
+                ('in_amount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'trade pool',
+                'verbose_name_plural': 'trade pools',
+                'db_table': 'test_trade_pool',
+                'get_latest_by': 'updated_at',
+            },
+        ),
+    ]
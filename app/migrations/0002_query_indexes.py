@@ -0,0 +1,85 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:17
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_investments(apps, schema_editor):
+    """Fold duplicate (user_id, pool_id) investments into the oldest row so the unique constraint applies."""
+    TradeInvestment = apps.get_model("app", "TradeInvestment")
+    duplicates = (
+        TradeInvestment.objects.values("user_id", "pool_id")
+        .annotate(n=Count("id"), total=Sum("input"))
+        .filter(n__gt=1)
+    )
+    for dup in duplicates:
+        rows = list(
+            TradeInvestment.objects.select_for_update()
+            .filter(user_id=dup["user_id"], pool_id=dup["pool_id"])
+            .order_by("created_at", "id")
+        )
+        keep, extra = rows[0], rows[1:]
+        keep.input = dup["total"]
+        keep.save(update_fields=["input", "updated_at"])
+        TradeInvestment.objects.filter(id__in=[r.id for r in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tradepool',
+            name='is_closed',
+            field=models.BooleanField(default=False, verbose_name='is closed'),
+        ),
+        migrations.AddField(
+            model_name='telegramuser',
+            name='realized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='realized pnl'),
+        ),
+        migrations.AddField(
+            model_name='telegramuser',
+            name='total_invested',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='total invested'),
+        ),
+        migrations.AddField(
+            model_name='telegramuser',
+            name='unrealized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='unrealized pnl'),
+        ),
+        migrations.AddField(
+            model_name='tradepool',
+            name='investor_count',
+            field=models.IntegerField(default=0, verbose_name='investor count'),
+        ),
+        migrations.AddField(
+            model_name='tradepool',
+            name='total_invested',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='total invested'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeinvestment',
+            index=models.Index(fields=['pool_id'], name='trade_investment_pool_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeinvestment',
+            index=models.Index(fields=['updated_at', 'id'], name='trade_inv_updated_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradepool',
+            index=models.Index(fields=['curr_value'], include=('id', 'user_id', 'active', 'is_long', 'is_order', 'order', 'final_amount', 'stop_loss', 'take_profit', 'leverage', 'in_amount', 'is_closed', 'total_invested', 'investor_count'), name='trade_pool_curr_value_cover'),
+        ),
+        migrations.AddIndex(
+            model_name='tradepool',
+            index=models.Index(fields=['updated_at', 'id'], name='trade_pool_updated_id_idx'),
+        ),
+        migrations.RunPython(merge_investments, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='tradeinvestment',
+            constraint=models.UniqueConstraint(fields=('user_id', 'pool_id'), name='trade_investment_user_pool_uniq'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradeInvestmentTombstone',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('user_id', models.UUIDField(editable=False)),
+                ('pool_id', models.UUIDField(editable=False)),
+                ('deleted_at', models.DateTimeField(verbose_name='deleted at')),
+            ],
+            options={
+                'verbose_name': 'trade investment tombstone',
+                'verbose_name_plural': 'trade investment tombstones',
+                'db_table': 'test_trade_investment_tombstone',
+                'indexes': [models.Index(fields=['deleted_at', 'id'], name='trade_inv_tomb_deleted_id_idx')],
+            },
+        ),
+    ]
@@ -1,14 +1,170 @@
+import datetime
 import uuid
-from django.db import models
+from django.db import connection, models
+from django.utils import timezone
+
+from project import settings
+
+# How long deleted investments are remembered for delta snapshots. A client
+# whose cursor is older has to start over from a full snapshot.
+TOMBSTONE_TTL = datetime.timedelta(seconds=getattr(settings, "TOMBSTONE_TTL", 7 * 24 * 3600))
+
+# Return of a pool on its capital (the creator's final_amount plus the
+# server-kept total_invested); the share every stake in it gained or lost.
+POOL_RETURN = "COALESCE(p.curr_value / NULLIF(p.final_amount + p.total_invested, 0) - 1, 0)"
+
+
+def _open_gains(pools: str, invs: str, users: str | None = None) -> str:
+    # (user_id, g): every stake in an open pool and its gain at the pool's
+    # current value: the creator's final_amount and each investor's input.
+    # ``users`` is an optional subquery of the user ids to cover.
+    pool_users = f"AND p.user_id IN ({users})" if users else ""
+    inv_users = f"AND i.user_id IN ({users})" if users else ""
+    return f"""
+        SELECT p.user_id, p.final_amount * {POOL_RETURN} AS g
+        FROM {pools} p WHERE NOT p.is_closed {pool_users}
+        UNION ALL
+        SELECT i.user_id, i.input * {POOL_RETURN}
+        FROM {invs} i JOIN {pools} p ON i.pool_id = p.id WHERE NOT p.is_closed {inv_users}
+    """
+
+
+class TelegramUserManager(models.Manager):
+    """
+    Aggregates kept on the user row so the leaderboard and the auth payload
+    never sum investments:
+
+    - ``total_invested``: sum of the user's investment inputs
+    - ``realized_pnl``: gains of closed pools, for the creator's
+      ``final_amount`` and for every investor's ``input``
+    - ``unrealized_pnl``: gains on open pools, the creator's on their own
+      pool and every investor's on the pools they are in
+    - ``pnl``: rounded realized + unrealized, the leaderboard score
+
+    ``rebuild`` recomputes all of them from scratch.
+    """
+
+    def add_invested(self, deltas: dict) -> None:
+        if not deltas:
+            return
+        table = self.model._meta.db_table
+        values, params = _values(sorted(deltas.items()), ("uuid", "numeric"))
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} u SET total_invested = u.total_invested + v.amount
+                FROM (VALUES {values}) v (id, amount)
+                WHERE u.id = v.id
+            """, params)
+
+    def revalue(self, pool_ids: list) -> list[tuple]:
+        """
+        Recompute the unrealized pnl of everyone with a stake in the pools
+        (creators and investors) over all their open pools. Returns (user_id, pnl).
+        """
+        if not pool_ids:
+            return []
+        table = self.model._meta.db_table
+        pools = TradePool._meta.db_table
+        invs = TradeInvestment._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH affected AS (
+                    SELECT user_id FROM {pools} WHERE id = ANY(%s::uuid[])
+                    UNION
+                    SELECT user_id FROM {invs} WHERE pool_id = ANY(%s::uuid[])
+                ), gains AS (
+                    SELECT a.user_id, COALESCE(ROUND(SUM(s.g), 2), 0) AS g
+                    FROM affected a LEFT JOIN ({_open_gains(pools, invs, "SELECT user_id FROM affected")}) s
+                        ON s.user_id = a.user_id
+                    GROUP BY a.user_id
+                )
+                UPDATE {table} u SET
+                    unrealized_pnl = gains.g,
+                    pnl = ROUND(u.realized_pnl + gains.g)
+                FROM gains
+                WHERE u.id = gains.user_id
+                RETURNING u.id, u.pnl
+            """, [[str(pk) for pk in pool_ids]] * 2)
+            return cursor.fetchall()
+
+    def realize(self, pool_ids: list) -> list[tuple]:
+        """
+        Book the final gains of just-closed pools for their creators and
+        investors, then drop them from their unrealized pnl. Call once per
+        pool, after it is marked closed. Returns (user_id, pnl).
+        """
+        if not pool_ids:
+            return []
+        table = self.model._meta.db_table
+        pools = TradePool._meta.db_table
+        invs = TradeInvestment._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH c AS (
+                    SELECT p.id, p.user_id, p.final_amount, {POOL_RETURN} AS r
+                    FROM {pools} p WHERE p.id = ANY(%s::uuid[])
+                ), gains AS (
+                    SELECT user_id, ROUND(SUM(g), 2) AS g FROM (
+                        SELECT i.user_id, i.input * c.r AS g
+                        FROM {invs} i JOIN c ON i.pool_id = c.id
+                        UNION ALL
+                        SELECT c.user_id, c.final_amount * c.r FROM c
+                    ) s GROUP BY user_id
+                )
+                UPDATE {table} u SET realized_pnl = u.realized_pnl + gains.g
+                FROM gains
+                WHERE u.id = gains.user_id
+            """, [[str(pk) for pk in pool_ids]])
+        return self.revalue(pool_ids)
+
+    def rebuild(self) -> int:
+        table = self.model._meta.db_table
+        pools = TradePool._meta.db_table
+        invs = TradeInvestment._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {table} SET total_invested = 0, realized_pnl = 0, unrealized_pnl = 0")
+            cursor.execute(f"""
+                UPDATE {table} u SET total_invested = s.total
+                FROM (SELECT user_id, SUM(input) AS total FROM {invs} GROUP BY user_id) s
+                WHERE u.id = s.user_id
+            """)
+            cursor.execute(f"""
+                UPDATE {table} u SET realized_pnl = s.g
+                FROM (
+                    SELECT user_id, ROUND(SUM(g), 2) AS g FROM (
+                        SELECT i.user_id, i.input * {POOL_RETURN} AS g
+                        FROM {invs} i JOIN {pools} p ON i.pool_id = p.id WHERE p.is_closed
+                        UNION ALL
+                        SELECT p.user_id, p.final_amount * {POOL_RETURN} FROM {pools} p WHERE p.is_closed
+                    ) gains GROUP BY user_id
+                ) s
+                WHERE u.id = s.user_id
+            """)
+            cursor.execute(f"""
+                UPDATE {table} u SET unrealized_pnl = s.g
+                FROM (
+                    SELECT user_id, ROUND(SUM(g), 2) AS g
+                    FROM ({_open_gains(pools, invs)}) gains GROUP BY user_id
+                ) s
+                WHERE u.id = s.user_id
+            """)
+            cursor.execute(f"UPDATE {table} SET pnl = ROUND(realized_pnl + unrealized_pnl)")
+            return cursor.rowcount
+
 
 class TelegramUser(models.Model):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True, unique=True, editable=False)
     username = models.CharField(max_length=150, null=True, unique=True)
     pnl = models.IntegerField(default=0)
+    total_invested = models.DecimalField(verbose_name='total invested', max_digits=14, decimal_places=2, default=0)
+    realized_pnl = models.DecimalField(verbose_name='realized pnl', max_digits=14, decimal_places=2, default=0)
+    unrealized_pnl = models.DecimalField(verbose_name='unrealized pnl', max_digits=14, decimal_places=2, default=0)
     img = models.CharField(max_length=300, null=True)
     created_at = models.DateTimeField(verbose_name='created at', auto_now_add=True)
     updated_at = models.DateTimeField(verbose_name='updated at', auto_now=True)
 
+    objects = TelegramUserManager()
+
     def __str__(self) -> str:
         return f"{self.username} with {self.pnl} pnl, created at {self.created_at}. Last update was {self.updated_at}"
 
@@ -19,6 +175,51 @@ class TelegramUser(models.Model):
         get_latest_by = "updated_at"
 
 
+class TradePoolManager(models.Manager):
+    """
+    ``total_invested`` and ``investor_count`` maintained next to the pool.
+    Raw updates bump ``updated_at`` themselves, so delta snapshots see them.
+    """
+
+    def add_investments(self, deltas: dict) -> list[tuple]:
+        # deltas: pool_id -> (input delta, investor count delta). Returns
+        # (id, total_invested, investor_count) of the updated pools.
+        if not deltas:
+            return []
+        table = self.model._meta.db_table
+        values, params = _values(
+            [(pk, amount, count) for pk, (amount, count) in sorted(deltas.items())], ("uuid", "numeric", "integer"),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} p SET
+                    total_invested = p.total_invested + v.amount,
+                    investor_count = p.investor_count + v.count,
+                    updated_at = %s
+                FROM (VALUES {values}) v (id, amount, count)
+                WHERE p.id = v.id
+                RETURNING p.id, p.total_invested, p.investor_count
+            """, params + [timezone.now()])
+            return cursor.fetchall()
+
+    def rebuild(self) -> int:
+        """Recompute both columns. Only pools that were off are written; returns their count."""
+        table = self.model._meta.db_table
+        invs = TradeInvestment._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} p SET total_invested = v.total, investor_count = v.count, updated_at = %s
+                FROM (
+                    SELECT p.id, COALESCE(s.total, 0) AS total, COALESCE(s.count, 0) AS count
+                    FROM {table} p LEFT JOIN (
+                        SELECT pool_id, SUM(input) AS total, COUNT(*) AS count FROM {invs} GROUP BY pool_id
+                    ) s ON s.pool_id = p.id
+                ) v
+                WHERE p.id = v.id AND (p.total_invested, p.investor_count) IS DISTINCT FROM (v.total, v.count)
+            """, [timezone.now()])
+            return cursor.rowcount
+
+
 class TradePool(models.Model):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True, unique=True, editable=False)
     user_id = models.UUIDField(unique=True, editable=False)
@@ -32,9 +233,14 @@ class TradePool(models.Model):
     leverage = models.DecimalField(max_digits=5, decimal_places=2)
     curr_value = models.DecimalField(verbose_name='curr value', max_digits=10, decimal_places=2, default=0)
     in_amount = models.PositiveIntegerField(default=0)
+    is_closed = models.BooleanField(verbose_name='is closed', default=False)
+    total_invested = models.DecimalField(verbose_name='total invested', max_digits=14, decimal_places=2, default=0)
+    investor_count = models.IntegerField(verbose_name='investor count', default=0)
     created_at = models.DateTimeField(verbose_name='created at', auto_now_add=True)
     updated_at = models.DateTimeField(verbose_name='updated at', auto_now=True)
 
+    objects = TradePoolManager()
+
     def __str__(self) -> str:
         return f"trade pool, creator id: {self.user_id}, final amount: {self.final_amount}, current value: {self.curr_value}"
 
@@ -43,6 +249,55 @@ class TradePool(models.Model):
         verbose_name_plural = "trade pools"
         db_table = "test_trade_pool"
         get_latest_by = "updated_at"
+        indexes = [
+            # Sorted listing on auth: an index-only scan in curr_value order.
+            models.Index(
+                fields=["curr_value"],
+                include=[
+                    "id", "user_id", "active", "is_long", "is_order", "order", "final_amount",
+                    "stop_loss", "take_profit", "leverage", "in_amount", "is_closed",
+                    "total_invested", "investor_count",
+                ],
+                name="trade_pool_curr_value_cover",
+            ),
+            # Keyset pagination of delta snapshots.
+            models.Index(fields=["updated_at", "id"], name="trade_pool_updated_id_idx"),
+        ]
+
+
+class TradeInvestmentManager(models.Manager):
+    def upsert(self, rows: list[tuple]) -> list[tuple]:
+        """
+        Insert-or-increment in one statement. Each row is
+        (user_id, pool_id, input, amount): a new row is created with ``input``,
+        an existing one gets ``amount`` added to it. Keys must be unique within
+        ``rows``. Returns (id, user_id, pool_id, input, inserted) per row.
+        """
+        if not rows:
+            return []
+
+        table = self.model._meta.db_table
+        now = timezone.now()
+        values = ", ".join(["(%s::uuid, %s::uuid, %s::uuid, %s::numeric, %s::numeric)"] * len(rows))
+        params = []
+        for user_id, pool_id, input, amount in rows:
+            params += [uuid.uuid4(), user_id, pool_id, input, amount]
+
+        sql = f"""
+            WITH v (id, user_id, pool_id, input, amount) AS (VALUES {values})
+            INSERT INTO {table} (id, user_id, pool_id, input, created_at, updated_at)
+            SELECT v.id, v.user_id, v.pool_id, v.input, %s, %s FROM v
+            ON CONFLICT (user_id, pool_id) DO UPDATE SET
+                input = {table}.input + (
+                    SELECT v.amount FROM v
+                    WHERE v.user_id = EXCLUDED.user_id AND v.pool_id = EXCLUDED.pool_id
+                ),
+                updated_at = EXCLUDED.updated_at
+            RETURNING id, user_id, pool_id, input, (xmax = 0) AS inserted
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [now, now])
+            return cursor.fetchall()
 
 
 class TradeInvestment(models.Model):
@@ -53,6 +308,8 @@ class TradeInvestment(models.Model):
     created_at = models.DateTimeField(verbose_name='created at', auto_now_add=True)
     updated_at = models.DateTimeField(verbose_name='updated at', auto_now=True)
 
+    objects = TradeInvestmentManager()
+
     def __str__(self) -> str:
         return f"user id: {self.user_id}, pool id: {self.pool_id}, amount: {self.input}, last update: {self.updated_at}"
 
@@ -61,3 +318,43 @@ class TradeInvestment(models.Model):
         verbose_name_plural = "trade investments"
         db_table = "test_trade_investment"
         get_latest_by = "updated_at"
+        constraints = [
+            # Also serves the (user_id, pool_id) lookups and user_id-only filters.
+            models.UniqueConstraint(fields=["user_id", "pool_id"], name="trade_investment_user_pool_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["pool_id"], name="trade_investment_pool_idx"),
+            models.Index(fields=["updated_at", "id"], name="trade_inv_updated_id_idx"),
+        ]
+
+
+class TradeInvestmentTombstoneManager(models.Manager):
+    def bury(self, rows: list[tuple]) -> None:
+        """Record deleted investments, (id, user_id, pool_id) each, and forget expired ones."""
+        now = timezone.now()
+        self.bulk_create(
+            [self.model(id=pk, user_id=user_id, pool_id=pool_id, deleted_at=now) for pk, user_id, pool_id in rows],
+            ignore_conflicts=True,
+        )
+        self.filter(deleted_at__lt=now - TOMBSTONE_TTL).delete()
+
+
+class TradeInvestmentTombstone(models.Model):
+    """A deleted investment, kept so delta snapshots can report the deletion."""
+    id = models.UUIDField(primary_key=True, editable=False)
+    user_id = models.UUIDField(editable=False)
+    pool_id = models.UUIDField(editable=False)
+    deleted_at = models.DateTimeField(verbose_name='deleted at')
+
+    objects = TradeInvestmentTombstoneManager()
+
+    def __str__(self) -> str:
+        return f"user id: {self.user_id}, pool id: {self.pool_id}, deleted at: {self.deleted_at}"
+
+    class Meta:
+        verbose_name = "trade investment tombstone"
+        verbose_name_plural = "trade investment tombstones"
+        db_table = "test_trade_investment_tombstone"
+        indexes = [
+            models.Index(fields=["deleted_at", "id"], name="trade_inv_tomb_deleted_id_idx"),
+        ]
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from django.core.exceptions import ImproperlyConfigured
+
+from app.broadcast import encode_tick, merge_tick, without_events
+from app.events import EVENT_REPLAY_LIMIT
+from app.metrics import OUTBOX_DROPPED, OUTBOX_OVERFLOWS, OUTBOX_QUEUED, OUTBOX_SEND_SECONDS, OUTBOX_UNACKED
+from app.wire import JSON, encode
+from project import settings
+
+logger = logging.getLogger("outbox")
+
+# Broadcast frames queued for one socket before it counts as a slow
+# consumer, and the depth it has to drain to before broadcasts are queued
+# again. Replies and replayed events do not count.
+OUTBOX_HIGH_WATER = getattr(settings, "OUTBOX_HIGH_WATER", 2000)
+OUTBOX_LOW_WATER = getattr(settings, "OUTBOX_LOW_WATER", 200)
+# "resync": drop the queued broadcasts and tell the client to catch up from
+# the event log; "close": disconnect it right away.
+OUTBOX_POLICY = getattr(settings, "OUTBOX_POLICY", "resync")
+# Recent event ids remembered per socket to drop a second copy of an event
+# that reached it through another topic group.
+OUTBOX_SEEN_SIZE = getattr(settings, "OUTBOX_SEEN_SIZE", 4096)
+# Still behind, or overflowing again, this many seconds after an overflow
+# closes the socket either way.
+OUTBOX_EVICT_AFTER = getattr(settings, "OUTBOX_EVICT_AFTER", 30.0)
+
+# A full replay is one burst of frames: it must fit below the watermark.
+if EVENT_REPLAY_LIMIT >= OUTBOX_HIGH_WATER:
+    raise ImproperlyConfigured(
+        f"EVENT_REPLAY_LIMIT ({EVENT_REPLAY_LIMIT}) must be below OUTBOX_HIGH_WATER ({OUTBOX_HIGH_WATER})"
+    )
+
+
+class Outbox:
+    """
+    Per-socket send queue. Frames with a key replace an unsent frame with the
+    same key (ticks are merged, other keyed frames are superseded), so a
+    client that falls behind gets fewer, fresher frames instead of every
+    stale one. Frames without a key are always delivered, in order.
+
+    Broadcast frames are ``droppable``. A socket is behind when more than
+    ``high_water`` broadcasts are waiting: the queued ones are dropped, new
+    ones are dropped until it is back to ``low_water``, and once anything was
+    dropped it gets one ``resync`` error. Other frames (replies, replays) are
+    never dropped and do not count.
+
+    Frames handed to ``send`` sit in the server's transport buffer, which
+    accepts them without backpressure, so the queue alone only grows while
+    the event loop is starved. Clients that ``ack`` the number of frames they
+    have received also count their unacknowledged frames, which is what
+    grows for a slow network reader.
+
+    A socket still behind ``evict_after`` seconds after an overflow, one that
+    overflows again within that time, or any overflow with the "close"
+    policy is handed to ``on_evict``.
+    """
+
+    def __init__(self, send: Callable[[str | bytes], Awaitable[None]], codec: str = JSON,
+                 on_evict: Callable[[], Awaitable[None]] | None = None,
+                 high_water: int = OUTBOX_HIGH_WATER, low_water: int = OUTBOX_LOW_WATER,
+                 policy: str = OUTBOX_POLICY, evict_after: float = OUTBOX_EVICT_AFTER):
+        self._send = send
+        self._codec = codec
+        self._on_evict = on_evict
+        self._queue: OrderedDict[object, tuple[str | bytes, dict | None, bool]] = OrderedDict()
+        self._droppable = 0
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.evict_after = evict_after
+        self.behind = False
+        self.resync_queued = False
+        self.evicting = False
+        self.last_overflow = -float("inf")
+
+        # Every frame sent on the socket, and the client's count of received
+        # ones (None until it acks for the first time).
+        self.frames_sent = 0
+        self.received: int | None = None
+
+        self.dropped = 0
+        self.overflows = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @property
+    def unacked(self) -> int:
+        return 0 if self.received is None else self.frames_sent - self.received
+
+    @property
+    def depth(self) -> int:
+        return self._droppable + self.unacked
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self._clear()
+
+    def _clear(self) -> None:
+        OUTBOX_QUEUED.dec(len(self._queue))
+        self._queue.clear()
+        self._droppable = 0
+
+    def ack(self, received: int) -> None:
+        self.received = max(self.received or 0, min(received, self.frames_sent))
+        OUTBOX_UNACKED.observe(self.unacked)
+        self._caught_up()
+
+    def put(self, key: str | None, frame: str | bytes, data: dict | None = None, droppable: bool = False,
+            ids: list[str] | None = None) -> None:
+        """
+        ``ids`` are the events in the frame. Ones already put are left out:
+        the frame is skipped, or a tick is re-encoded without them.
+        """
+        if self.evicting:
+            return
+        if ids:
+            fresh = [event_id for event_id in ids if event_id not in self._seen]
+            if not fresh:
+                self._drop("duplicate")
+                return
+            if len(fresh) < len(ids) and data is not None:
+                data = without_events(data, set(ids) - set(fresh))
+                frame = encode_tick(data, self._codec)
+            for event_id in fresh:
+                self._seen[event_id] = None
+            while len(self._seen) > OUTBOX_SEEN_SIZE:
+                self._seen.popitem(last=False)
+        if droppable and self.behind:
+            self._drop("behind")
+            self._lost()
+            if time.monotonic() - self.last_overflow > self.evict_after:
+                self._evict()
+            self._wakeup.set()
+            return
+
+        if key is None:
+            key = self._seq
+            self._seq += 1
+        elif key in self._queue:
+            _, pending, was_droppable = self._queue[key]
+            if data is not None and pending is not None:
+                data = merge_tick(pending, data)
+                frame = encode_tick(data, self._codec)
+            self._drop("superseded")
+            self._droppable -= was_droppable
+            OUTBOX_QUEUED.dec()
+
+        self._queue[key] = (frame, data, droppable)
+        self._droppable += droppable
+        OUTBOX_QUEUED.inc()
+        if droppable and self.depth > self.high_water:
+            self._overflow()
+        self._wakeup.set()
+
+    def _drop(self, reason: str, count: int = 1) -> None:
+        self.dropped += count
+        OUTBOX_DROPPED.labels(reason).inc(count)
+
+    def _evict(self) -> None:
+        OUTBOX_OVERFLOWS.labels("evict").inc()
+        self.evicting = True
+
+    def _overflow(self) -> None:
+        now = time.monotonic()
+        self.overflows += 1
+        if self.policy == "close" or now - self.last_overflow < self.evict_after:
+            self._evict()
+            return
+        self.last_overflow = now
+        self.behind = True
+        OUTBOX_OVERFLOWS.labels("resync").inc()
+
+        kept = OrderedDict((k, v) for k, v in self._queue.items() if not v[2])
+        purged = len(self._queue) - len(kept)
+        if purged:
+            self._drop("purged", purged)
+            OUTBOX_QUEUED.dec(purged)
+            self._queue = kept
+            self._droppable = 0
+            self._lost()
+
+    def _lost(self) -> None:
+        # Broadcasts were dropped: same error events/replay sends for a gap,
+        # the client still has the seq of the last frame it got and catches
+        # up with events/replay. Once per time behind.
+        if self.resync_queued:
+            return
+        self.resync_queued = True
+        resync = {"type": "error", "code": "resync", "message": "Too far behind, updates were dropped"}
+        self._queue[self._seq] = (encode(resync, self._codec), None, False)
+        self._seq += 1
+        OUTBOX_QUEUED.inc()
+
+    def _caught_up(self) -> None:
+        if self.behind and self.depth <= self.low_water:
+            self.behind = False
+            self.resync_queued = False
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue and not self.evicting:
+                _, (frame, _, droppable) = self._queue.popitem(last=False)
+                self._droppable -= droppable
+                OUTBOX_QUEUED.dec()
+                started = time.perf_counter()
+                try:
+                    await self._send(frame)
+                except Exception as ex:
+                    logger.exception(ex)
+                OUTBOX_SEND_SECONDS.observe(time.perf_counter() - started)
+                self._caught_up()
+
+            if self.evicting:
+                self._clear()
+                if self._on_evict is not None:
+                    await self._on_evict()
+                return
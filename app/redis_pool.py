@@ -0,0 +1,32 @@
+import asyncio
+import weakref
+
+import redis.asyncio as aioredis
+
+from project import settings
+
+REDIS_URL = getattr(settings, "REDIS_URL", "redis://localhost:6379")
+REDIS_MAX_CONNECTIONS = getattr(settings, "REDIS_MAX_CONNECTIONS", 64)
+# Number of main.pools_channel.N / main.investments_channel.N pub/sub shards
+# (see app.sharding); 1 keeps the plain channel names.
+PUBSUB_SHARDS = getattr(settings, "PUBSUB_SHARDS", 1)
+
+# asyncio connections are bound to the loop that opened them, so the shared
+# client is kept per running loop (Daphne has exactly one).
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aioredis.Redis]" = weakref.WeakKeyDictionary()
+
+
+def get_redis() -> aioredis.Redis:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        # Blocking pool: under a burst callers wait for a free connection
+        # instead of failing with "Too many connections".
+        pool = aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            decode_responses=True,
+        )
+        client = aioredis.Redis(connection_pool=pool)
+        _clients[loop] = client
+    return client
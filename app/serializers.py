@@ -1,4 +1,7 @@
+import decimal
+
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from .models import TelegramUser, TradePool, TradeInvestment
 
 class TelegramUserSerializer(serializers.ModelSerializer):
@@ -16,4 +19,61 @@ class TradePoolSerializer(serializers.ModelSerializer):
 class TradeInvestmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = TradeInvestment
-        exclude = ['created_at', 'updated_at']
\ No newline at end of file
+        exclude = ['created_at', 'updated_at']
+
+class FastSerializer:
+    """
+    Read-only fast path for a ModelSerializer over a whole queryset: rows are
+    read with ``values_list()`` and turned into dicts by a field plan compiled
+    once, without a model instance or field lookup per row. The output is the
+    same as ``serializer_class(queryset, many=True).data``.
+    """
+
+    def __init__(self, serializer_class: type[serializers.ModelSerializer]):
+        self.names = []
+        self.sources = []
+        self.converters = []
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if field.source == "*" or "." in field.source:
+                raise ValueError(f"{serializer_class.__name__}.{name}: only plain model fields are supported")
+            self.names.append(name)
+            self.sources.append(field.source)
+            self.converters.append(self.converter(field))
+
+    @staticmethod
+    def converter(field: serializers.Field):
+        # None means the DB value is already what to_representation returns.
+        if isinstance(field, (serializers.BooleanField, serializers.IntegerField, serializers.CharField)):
+            return None
+        if isinstance(field, serializers.UUIDField) and field.uuid_format == "hex_verbose":
+            return str
+        if (isinstance(field, serializers.DecimalField) and field.decimal_places is not None
+                and getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+                and not field.localize and not getattr(field, "normalize_output", False)):
+            context = decimal.getcontext().copy()
+            if field.max_digits is not None:
+                context.prec = field.max_digits
+            exponent = decimal.Decimal(".1") ** field.decimal_places
+            rounding = field.rounding
+
+            def to_string(value):
+                if not isinstance(value, decimal.Decimal):
+                    value = decimal.Decimal(str(value).strip())
+                return "{:f}".format(value.quantize(exponent, rounding=rounding, context=context))
+
+            return to_string
+        return field.to_representation
+
+    def serialize(self, queryset) -> list[dict]:
+        plan = list(zip(self.names, self.converters))
+        return [
+            {name: value if convert is None or value is None else convert(value)
+             for (name, convert), value in zip(plan, row)}
+            for row in queryset.values_list(*self.sources)
+        ]
+
+
+trade_pool_fast = FastSerializer(TradePoolSerializer)
+trade_investment_fast = FastSerializer(TradeInvestmentSerializer)
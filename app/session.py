@@ -0,0 +1,91 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from app.redis_pool import get_redis
+from app.sharding import USERS_CHANNEL
+from project import settings
+
+logger = logging.getLogger("session")
+
+USER_CACHE_SIZE = getattr(settings, "USER_CACHE_SIZE", 10_000)
+USER_CACHE_TTL = getattr(settings, "USER_CACHE_TTL", 60)
+
+
+class UserCache:
+    """
+    Bounded LRU of serialized users with a TTL. Deletes invalidate the entry
+    in this process; users whose aggregates change are announced on
+    USERS_CHANNEL (see ``queue_changed``) and dropped in every process. The
+    TTL bounds how long another process can serve a user deleted elsewhere.
+    """
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._users: OrderedDict[uuid.UUID, tuple[float, dict]] = OrderedDict()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            pubsub = get_redis().pubsub()
+            try:
+                await pubsub.subscribe(USERS_CHANNEL)
+                # Changes announced while unsubscribed are unknown.
+                self._users.clear()
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg is not None and msg["type"] == "message":
+                        for user_id in json.loads(msg["data"]):
+                            self.invalidate(uuid.UUID(user_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.exception(str(ex))
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def get(self, user_id: uuid.UUID) -> dict | None:
+        entry = self._users.get(user_id, None)
+        if entry is None:
+            return None
+        expires, user = entry
+        if expires < time.monotonic():
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    def put(self, user_id: uuid.UUID, user: dict) -> None:
+        self._users[user_id] = (time.monotonic() + self.ttl, user)
+        self._users.move_to_end(user_id)
+        if len(self._users) > self.size:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id: uuid.UUID) -> None:
+        self._users.pop(user_id, None)
+
+
+def queue_changed(pipe, user_ids) -> None:
+    """Announce changed user rows to every process's user cache (a PUBLISH on ``pipe``)."""
+    if user_ids:
+        pipe.publish(USERS_CHANNEL, json.dumps([str(user_id) for user_id in user_ids]))
+
+
+class Session:
+    """What an authenticated connection knows about its user."""
+
+    def __init__(self, user_id: uuid.UUID, user: dict):
+        self.user_id = user_id
+        self.user = user
+
+
+user_cache = UserCache()
@@ -0,0 +1,83 @@
+"""
+Routing helpers for running several consumer and listener processes.
+
+Kept free of ``project.settings`` imports so settings.py itself can use
+``channel_layers`` to build ``CHANNEL_LAYERS``.
+"""
+from zlib import crc32
+
+POOLS_CHANNEL = "main.pools_channel"
+INVESTMENTS_CHANNEL = "main.investments_channel"
+DASH_CHANNEL = "main.dash_channel"
+# User ids whose row changed, for the per-process user caches. Outside
+# main.* and the event log: clients never see it.
+USERS_CHANNEL = "users.changed"
+
+# Durable copies of the same events (see app.events).
+EVENT_STREAM = "events"
+DASH_STREAM = "events.dash"
+
+
+def shard_of(key, count: int) -> int:
+    """Stable shard for a routing key (a pool id); same in every process."""
+    if count <= 1:
+        return 0
+    return crc32(str(key).encode()) % count
+
+
+def routing_key(message) -> str | None:
+    """
+    The pool a published message is about. Everything about one pool goes
+    through the same channel shard and listener worker, which keeps it in
+    order; the dashboard payload (a list) has no key.
+    """
+    if not isinstance(message, dict):
+        return None
+    pool = message.get("pool", None)
+    if pool and pool.get("id", None) is not None:
+        return str(pool["id"])
+    for inv in (message.get("investment", None), message.get("deleted", None)):
+        if inv and inv.get("pool_id", None) is not None:
+            return str(inv["pool_id"])
+    return None
+
+
+def pubsub_channel(base: str, key, shards: int) -> str:
+    # With one shard the channel names stay what they always were.
+    if shards <= 1:
+        return base
+    return f"{base}.{shard_of(key, shards)}"
+
+
+def streams(shards: int) -> list[str]:
+    """Every event stream: one per channel shard plus the dashboard's."""
+    if shards <= 1:
+        return [EVENT_STREAM, DASH_STREAM]
+    return [f"{EVENT_STREAM}.{shard}" for shard in range(shards)] + [DASH_STREAM]
+
+
+def listener_streams(shard_index: int, shard_count: int, shards: int) -> list[str]:
+    """
+    Streams listener ``shard_index`` of ``shard_count`` reads. With sharded
+    streams every listener only reads its own (plus the dashboard on shard
+    0), so adding listeners divides the work instead of repeating it. With
+    one stream every listener reads it and keeps the pools it owns.
+    """
+    if shards <= 1:
+        return [EVENT_STREAM] + ([DASH_STREAM] if shard_index == 0 else [])
+    owned = [f"{EVENT_STREAM}.{shard}" for shard in range(shards) if shard % shard_count == shard_index]
+    return owned + ([DASH_STREAM] if shard_index == 0 else [])
+
+
+def channel_layers(urls: list[str], **config) -> dict:
+    """
+    ``CHANNEL_LAYERS`` for one or more Redis servers. channels-redis shards
+    groups and channels over all ``hosts`` by hash, so every process must
+    list the same URLs in the same order.
+    """
+    return {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [{"address": url} for url in urls], **config},
+        }
+    }
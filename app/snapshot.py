@@ -0,0 +1,108 @@
+import base64
+import datetime
+import uuid
+
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+from rest_framework.serializers import ModelSerializer
+
+from app.models import TOMBSTONE_TTL
+from project import settings
+
+SNAPSHOT_PAGE_SIZE = getattr(settings, "SNAPSHOT_PAGE_SIZE", 500)
+SNAPSHOT_MAX_PAGE_SIZE = getattr(settings, "SNAPSHOT_MAX_PAGE_SIZE", 5000)
+
+Cursor = tuple[datetime.datetime, uuid.UUID | None]
+
+
+def encode_cursor(updated_at: datetime.datetime, pk: uuid.UUID) -> str:
+    raw = f"{updated_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str | None) -> Cursor | None:
+    """
+    Accepts either an opaque cursor returned by a previous page or a bare
+    ISO-8601 ``updated_at`` value. Raises ValueError on anything else.
+    """
+    if not token:
+        return None
+
+    try:
+        return datetime.datetime.fromisoformat(token), None
+    except ValueError:
+        pass
+
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        updated_at, pk = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.datetime.fromisoformat(updated_at), uuid.UUID(pk)
+    except Exception as ex:
+        raise ValueError(f"invalid snapshot cursor: {token!r}") from ex
+
+
+def clamp_page_size(page_size: int | None) -> int:
+    if not page_size:
+        return SNAPSHOT_PAGE_SIZE
+    return max(1, min(int(page_size), SNAPSHOT_MAX_PAGE_SIZE))
+
+
+def expired(at: datetime.datetime) -> bool:
+    if timezone.is_naive(at):
+        at = timezone.make_aware(at, datetime.timezone.utc)
+    return at < timezone.now() - TOMBSTONE_TTL
+
+
+def after(queryset: QuerySet, cursor: Cursor | None, field: str) -> QuerySet:
+    qs = queryset.order_by(field, "id")
+    if cursor is None:
+        return qs
+    at, pk = cursor
+    if pk is None:
+        return qs.filter(**{f"{field}__gte": at})
+    return qs.filter(Q(**{f"{field}__gt": at}) | Q(**{field: at, "id__gt": pk}))
+
+
+def changes_page(queryset: QuerySet, serializer_class: type[ModelSerializer],
+                 token: str | None = None, page_size: int | None = None,
+                 tombstones: QuerySet | None = None) -> dict:
+    """
+    One page of rows changed after ``token``, in (updated_at, id) keyset order.
+    The returned cursor always points at the last row sent, so the client can
+    keep the final one per table and hand it back in ``params.snapshot.pools``
+    / ``params.snapshot.invs`` on its next auth (``since`` is the event-log
+    resume key, not a cursor).
+
+    With ``tombstones`` (rows with ``deleted_at``) rows deleted after
+    ``token`` are listed in ``deleted``, interleaved in the same order. A
+    cursor older than the tombstones are kept gets ``reset``: the client
+    drops what it has and starts over without a cursor.
+    """
+    cursor = decode_cursor(token)
+    page_size = clamp_page_size(page_size)
+
+    if tombstones is not None and cursor is not None and expired(cursor[0]):
+        return {"items": [], "deleted": [], "cursor": None, "more": False, "reset": True}
+
+    changed = [(row.updated_at, row.id, row) for row in after(queryset, cursor, "updated_at")[:page_size + 1]]
+    # Nothing was deleted from the client's point of view without a cursor.
+    if tombstones is not None and cursor is not None:
+        changed += [(row.deleted_at, row.id, row) for row in after(tombstones, cursor, "deleted_at")[:page_size + 1]]
+        changed.sort(key=lambda change: change[:2])
+
+    more = len(changed) > page_size
+    changed = changed[:page_size]
+    deleted = tombstones.model if tombstones is not None else ()
+    rows = [row for _, _, row in changed if not isinstance(row, deleted)]
+
+    page = {
+        "items": serializer_class(rows, many=True).data,
+        "cursor": encode_cursor(*changed[-1][:2]) if changed else token,
+        "more": more,
+    }
+    if tombstones is not None:
+        page["deleted"] = [
+            {"id": str(row.id), "user_id": str(row.user_id), "pool_id": str(row.pool_id)}
+            for _, _, row in changed if isinstance(row, deleted)
+        ]
+    return page
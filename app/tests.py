@@ -0,0 +1,585 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import nullcontext
+from types import SimpleNamespace
+from decimal import Decimal
+from unittest import mock
+
+from django.db import DataError, OperationalError
+from django.db.models import Q
+from django.test import SimpleTestCase
+
+from app.broadcast import TickScheduler, add_event, empty_tick
+from app.cache import SnapshotCache, snapshot_cache
+from app.consumers import PoolConsumer
+from app.dispatch import NULLABLE_NUMBER, Handler, ValidationError
+from app.events import EVENT_REPLAY_LIMIT
+from app.management.commands.listener import Listener
+from app.outbox import Outbox
+from app.models import TradeInvestment, TradePool
+from app.serializers import (
+    TradeInvestmentSerializer, TradePoolSerializer, trade_investment_fast, trade_pool_fast,
+)
+from app.session import user_cache
+from app.snapshot import after, changes_page, decode_cursor, encode_cursor
+from app import utils
+from app.sharding import INVESTMENTS_CHANNEL, POOLS_CHANNEL, USERS_CHANNEL
+from app.valuation import MAX_VALUE, Book, ValuationEngine
+from app.wire import JSON, MSGPACK, Prefix, encode, pack, unpack
+from app.writebehind import Batch, WriteBehindQueue, clean_pool
+
+USER_A, USER_B = str(uuid.uuid4()), str(uuid.uuid4())
+POOL_A, POOL_B = str(uuid.uuid4()), str(uuid.uuid4())
+
+
+class SnapshotCacheTests(SimpleTestCase):
+    def test_update_of_an_unknown_pool_waits_for_the_reload(self):
+        cache = SnapshotCache()
+        cache.ready = True
+        cache._pools = {POOL_B: {"id": POOL_B, "curr_value": "5.00"}, "partial": {"id": "partial"}}
+        cache.apply("main.pools", json.dumps({"pool": {"id": POOL_A, "curr_value": "1.00"}}))
+
+        self.assertNotIn(POOL_A, cache._pools)
+        self.assertEqual([p["id"] for p in cache.pools()], ["partial", POOL_B])
+
+    def test_updates_only_change_the_mutable_columns(self):
+        cache = SnapshotCache()
+        cache.ready = True
+        row = {**ValuationTests.POOL, "id": POOL_A}
+        cache.apply(INVESTMENTS_CHANNEL, json.dumps({"pool": row}))
+        self.assertNotIn(POOL_A, cache._pools)
+        cache.apply(POOLS_CHANNEL, json.dumps({"pool": row}))
+
+        cache.apply(INVESTMENTS_CHANNEL, json.dumps({"pool": {
+            "id": POOL_A, "curr_value": "7.5", "user_id": USER_B, "leverage": "100", "stop_loss": "abc",
+        }}))
+        with self.assertRaises(ValueError):
+            cache.apply(INVESTMENTS_CHANNEL, json.dumps({"pool": {"id": POOL_A, "in_amount": "abc"}}))
+
+        pool = cache._pools[POOL_A]
+        self.assertEqual((pool["curr_value"], pool["user_id"], pool["leverage"]), ("7.50", USER_A, "1.00"))
+        self.assertEqual(pool["in_amount"], 0)
+
+class DbFlushTests(SimpleTestCase):
+    """``WriteBehindQueue.db_flush`` against mocked managers: which rows and aggregate deltas it writes."""
+
+    def flush(self, batch: Batch, deleted: list[tuple] = (), upserted: list[tuple] = ()) -> dict:
+        investments = mock.MagicMock()
+        investments.filter.return_value.order_by.return_value \
+            .select_for_update.return_value.values_list.return_value = list(deleted)
+        investments.upsert.return_value = list(upserted)
+        with mock.patch("app.writebehind.transaction.atomic", nullcontext), \
+                mock.patch("app.writebehind.TradeInvestment.objects", investments), \
+                mock.patch("app.writebehind.TradePool.objects") as pools, \
+                mock.patch("app.writebehind.TelegramUser.objects") as users, \
+                mock.patch("app.writebehind.TradeInvestmentTombstone.objects") as tombstones:
+            WriteBehindQueue.db_flush.__wrapped__(batch)
+        return {"investments": investments, "pools": pools, "users": users, "tombstones": tombstones}
+
+    def test_pool_update_upsert_and_delete(self):
+        batch = Batch()
+        batch.update_pool({"id": POOL_A, "curr_value": Decimal("12.50"), "in_amount": 3})
+        batch.upsert_investment((USER_A, POOL_A), {"input": Decimal(100), "amount": Decimal(0), "rest": Decimal(0)})
+        batch.delete_investment((USER_B, POOL_B))
+
+        deleted_id = uuid.uuid4()
+        mocks = self.flush(
+            batch,
+            deleted=[(deleted_id, uuid.UUID(USER_B), uuid.UUID(POOL_B), Decimal(40))],
+            upserted=[(uuid.uuid4(), uuid.UUID(USER_A), uuid.UUID(POOL_A), Decimal(100), True)],
+        )
+
+        [(objs, fields), _] = mocks["pools"].bulk_update.call_args
+        self.assertEqual([str(obj.id) for obj in objs], [POOL_A])
+        self.assertEqual((objs[0].curr_value, objs[0].in_amount), (Decimal("12.50"), 3))
+        self.assertEqual(fields, ["curr_value", "in_amount", "updated_at"])
+
+        mocks["investments"].filter.return_value.order_by.return_value.delete.assert_called_once_with()
+        mocks["tombstones"].bury.assert_called_once_with([(deleted_id, uuid.UUID(USER_B), uuid.UUID(POOL_B))])
+        mocks["investments"].upsert.assert_called_once_with([(USER_A, POOL_A, Decimal(100), Decimal(0))])
+        mocks["users"].add_invested.assert_called_once_with({USER_A: Decimal(100), USER_B: Decimal(-40)})
+        mocks["pools"].add_investments.assert_called_once_with({
+            POOL_A: (Decimal(100), 1),
+            POOL_B: (Decimal(-40), -1),
+        })
+
+    def test_pools_are_written_in_id_order(self):
+        batch = Batch()
+        for pk in sorted([POOL_A, POOL_B], reverse=True):
+            batch.update_pool({"id": pk, "in_amount": 1})
+
+        mocks = self.flush(batch)
+
+        [(objs, _), _] = mocks["pools"].bulk_update.call_args
+        self.assertEqual([str(obj.id) for obj in objs], sorted([POOL_A, POOL_B]))
+
+    def test_top_up_does_not_count_an_investor(self):
+        batch = Batch()
+        batch.upsert_investment((USER_A, POOL_A), {"input": Decimal(100), "amount": Decimal(5), "rest": Decimal(0)})
+
+        mocks = self.flush(
+            batch, upserted=[(uuid.uuid4(), uuid.UUID(USER_A), uuid.UUID(POOL_A), Decimal(105), False)],
+        )
+
+        mocks["pools"].bulk_update.assert_not_called()
+        mocks["tombstones"].bury.assert_not_called()
+        mocks["users"].add_invested.assert_called_once_with({USER_A: Decimal(5)})
+        mocks["pools"].add_investments.assert_called_once_with({POOL_A: (Decimal(5), 0)})
+
+
+class WriteBehindQueueTests(SimpleTestCase):
+    def test_rejects_values_the_columns_cannot_hold(self):
+        queue = WriteBehindQueue()
+        for pool in (
+            {"id": POOL_A, "in_amount": -1},
+            {"id": POOL_A, "in_amount": 1.5},
+            {"id": POOL_A, "in_amount": 10 ** 8},
+            {"id": POOL_A, "curr_value": "1e9"},
+            {"id": POOL_A, "curr_value": "NaN"},
+            {"id": "nope", "curr_value": 1},
+        ):
+            with self.assertRaises(ValueError):
+                queue.update_pool(pool)
+        for inv in (
+            {"user_id": USER_A, "pool_id": POOL_A, "input": -5},
+            {"user_id": USER_A, "pool_id": POOL_A, "amount": "abc"},
+            {"user_id": USER_A},
+        ):
+            with self.assertRaises(ValueError):
+                queue.upsert_investment(inv)
+        self.assertEqual(queue.depth, 0)
+        self.assertEqual(clean_pool({"id": POOL_A, "curr_value": 3, "in_amount": "7"}),
+                         {"id": POOL_A, "curr_value": Decimal("3.00"), "in_amount": 7})
+
+    async def test_bad_row_is_isolated_and_dropped(self):
+        bad = str(uuid.uuid4())
+        written = []
+
+        async def db_flush(batch):
+            if any(pk == bad for pk in batch.pools):
+                raise DataError("numeric field overflow")
+            written.extend(batch.pools)
+
+        queue = WriteBehindQueue()
+        queue._batch = Batch.of([("pool", pk, {"in_amount": 1}) for pk in (POOL_A, bad, POOL_B)])
+        with mock.patch.object(WriteBehindQueue, "db_flush", staticmethod(db_flush)):
+            await queue.flush()
+
+        self.assertEqual(sorted(written), sorted([POOL_A, POOL_B]))
+        self.assertEqual((queue.dropped_rows, queue.depth), (1, 0))
+
+    async def test_transient_errors_keep_every_row(self):
+        calls = []
+
+        async def db_flush(batch):
+            calls.append(len(batch))
+            if len(calls) <= 3:
+                raise OperationalError("connection refused")
+
+        queue = WriteBehindQueue(interval=0, max_pending=2)
+        queue._batch = Batch.of([("pool", POOL_A, {"in_amount": 1})])
+        with mock.patch.object(WriteBehindQueue, "db_flush", staticmethod(db_flush)):
+            for _ in range(3):
+                await queue.flush()
+            self.assertEqual((queue.depth, queue.failing, queue.full), (1, True, False))
+            queue.update_pool({"id": POOL_B, "in_amount": 2})
+            self.assertTrue(queue.full)
+            await queue.flush()
+
+        self.assertEqual(calls, [1, 1, 1, 2])
+        self.assertEqual((queue.dropped_rows, queue.flushed_rows, queue.depth, queue.full), (0, 2, 0, False))
+
+    async def test_transient_error_while_isolating_requeues_the_rest(self):
+        bad = str(uuid.uuid4())
+        written = []
+
+        async def db_flush(batch):
+            if bad in batch.pools:
+                raise DataError("numeric field overflow")
+            if POOL_A in batch.pools:
+                raise OperationalError("server closed the connection")
+            written.append(batch.rows())
+
+        queue = WriteBehindQueue(interval=0)
+        queue._batch = Batch.of([("delete", (USER_A, POOL_B), None)] + [
+            ("pool", pk, {"in_amount": 1}) for pk in (bad, POOL_A, POOL_B)
+        ])
+        with mock.patch.object(WriteBehindQueue, "db_flush", staticmethod(db_flush)):
+            await queue.flush()
+
+        # [delete, bad] is bisected; [A, B] fails on the connection and is kept whole.
+        self.assertEqual(written, [[("delete", (USER_A, POOL_B), None)]])
+        self.assertEqual(queue.dropped_rows, 1)
+        self.assertEqual(list(queue._batch.pools), [POOL_A, POOL_B])
+        self.assertTrue(queue.failing)
+
+
+    async def test_flush_announces_the_changed_aggregates(self):
+        async def db_flush(batch):
+            return [(uuid.UUID(POOL_A), Decimal("150.00"), 2)], [USER_A]
+
+        queued, pipe = [], mock.MagicMock()
+        pipe.__aenter__.return_value = mock.MagicMock(execute=mock.AsyncMock())
+        user_cache.put(uuid.UUID(USER_A), {"id": USER_A})
+        queue = WriteBehindQueue()
+        queue._batch = Batch.of([("pool", POOL_A, {"in_amount": 1})])
+        with mock.patch.object(WriteBehindQueue, "db_flush", staticmethod(db_flush)), \
+                mock.patch("app.writebehind.get_redis") as redis, \
+                mock.patch("app.writebehind.events.queue", lambda pipe, channel, message: queued.append(message)):
+            redis.return_value.pipeline.return_value = pipe
+            await queue.flush()
+
+        self.assertEqual(queued, [{
+            "pool": {"id": POOL_A, "total_invested": "150.00", "investor_count": 2}, "investment": None,
+        }])
+        pipe.__aenter__.return_value.publish.assert_called_once_with(USERS_CHANNEL, json.dumps([USER_A]))
+        self.assertIsNone(user_cache.get(uuid.UUID(USER_A)))
+
+
+class OutboxTests(SimpleTestCase):
+    @staticmethod
+    async def drain(outbox: Outbox) -> None:
+        while len(outbox):
+            await asyncio.sleep(0)
+
+    async def outbox(self, **kwargs) -> tuple[Outbox, list]:
+        sent = []
+
+        async def send(frame):
+            sent.append(frame)
+
+        outbox = Outbox(send, **kwargs)
+        outbox.start()
+        return outbox, sent
+
+    async def test_full_replay_does_not_overflow(self):
+        outbox, sent = await self.outbox(high_water=EVENT_REPLAY_LIMIT + 1, low_water=10)
+        for i in range(EVENT_REPLAY_LIMIT):
+            outbox.put(None, f"event {i}")
+        outbox.put(None, "replay done")
+        outbox.put(None, "broadcast", droppable=True)
+        await self.drain(outbox)
+        outbox.stop()
+
+        self.assertEqual(len(sent), EVENT_REPLAY_LIMIT + 2)
+        self.assertEqual((outbox.overflows, outbox.dropped), (0, 0))
+
+    async def test_overflow_drops_broadcasts_and_sends_one_resync(self):
+        outbox, sent = await self.outbox(high_water=5, low_water=1)
+        outbox.put(None, "reply")
+        for i in range(10):
+            outbox.put(None, f"broadcast {i}", droppable=True)
+        await self.drain(outbox)
+        outbox.stop()
+
+        errors = [json.loads(frame) for frame in sent if frame.startswith("{")]
+        self.assertEqual(sent[0], "reply")
+        self.assertEqual([e["code"] for e in errors], ["resync"])
+        self.assertEqual(outbox.overflows, 1)
+        self.assertFalse(outbox.behind)
+
+    async def test_unacked_frames_count_toward_the_watermark(self):
+        # The transport takes every frame at once; only the client's acks
+        # show that it has not read them.
+        outbox, sent = await self.outbox(high_water=5, low_water=2)
+        outbox.ack(0)
+        for i in range(7):
+            outbox.put(None, f"broadcast {i}", droppable=True)
+            await self.drain(outbox)
+            outbox.frames_sent = len(sent)
+
+        self.assertTrue(outbox.behind)
+        self.assertEqual(sent[:5], [f"broadcast {i}" for i in range(5)])
+        self.assertEqual([json.loads(frame)["code"] for frame in sent[5:]], ["resync"])
+        self.assertEqual(outbox.dropped, 2)
+
+        outbox.ack(len(sent))
+        outbox.stop()
+        self.assertFalse(outbox.behind)
+
+    async def test_event_from_a_second_topic_group_is_sent_once(self):
+        outbox, sent = await self.outbox()
+        outbox.put(None, "event 1", droppable=True, ids=["events/1-0"])
+        outbox.put(None, "event 1 again", droppable=True, ids=["events/1-0"])
+
+        first, second = empty_tick(), empty_tick()
+        add_event(first, {"investment": {"user_id": USER_A}}, event_id="events/2-0")
+        add_event(second, {"investment": {"user_id": USER_A}}, event_id="events/2-0")
+        add_event(second, {"deleted": {"user_id": USER_B}}, event_id="events/3-0")
+        outbox.put("tick:a", "tick a", first, droppable=True, ids=first["ids"])
+        outbox.put("tick:b", "tick b", second, droppable=True, ids=second["ids"])
+        await self.drain(outbox)
+        outbox.stop()
+
+        self.assertEqual(sent[:2], ["event 1", "tick a"])
+        tick = json.loads(sent[2])
+        self.assertEqual((tick["data"]["investments"], tick["data"]["deleted"]), ([], [{"user_id": USER_B}]))
+
+
+class TickSchedulerTests(SimpleTestCase):
+    async def test_entries_are_reported_once_all_their_groups_were_sent(self):
+        class Layer:
+            async def group_send(self, group, event):
+                if group == "user.broken":
+                    raise ConnectionError("channel layer down")
+
+        sent = []
+        scheduler = TickScheduler(Layer(), interval=0, on_sent=sent.extend)
+        scheduler.add(["main", "pool.a"], {"pool": {"id": "a"}}, {"events": "1-0"}, "first")
+        scheduler.add(["main", "user.broken"], {"investment": {"user_id": "b"}}, {"events": "2-0"}, "second")
+
+        task = asyncio.create_task(scheduler.run())
+        while not sent:
+            await asyncio.sleep(0)
+        task.cancel()
+
+        self.assertEqual(sent, ["first"])
+
+
+class ListenerTests(SimpleTestCase):
+    async def test_reclaim_reroutes_idle_pending_entries_page_by_page(self):
+        listener = Listener(claim_idle=30)
+        redis = mock.MagicMock(xautoclaim=mock.AsyncMock(side_effect=[
+            ["5-0", [("1-0", {"data": "{}"})], []],
+            ["0-0", [("5-0", {"data": "{}"})], ["3-0"]],
+        ]))
+        with mock.patch.object(listener, "route", mock.AsyncMock()) as route:
+            await listener.reclaim(redis, "events")
+
+        self.assertEqual([call.args[0]["id"] for call in route.await_args_list], ["1-0", "5-0"])
+        self.assertEqual(redis.xautoclaim.await_args_list[0].args[3], 30000)
+        self.assertEqual(redis.xautoclaim.await_args_list[1].kwargs["start_id"], "5-0")
+
+
+
+class WireTests(SimpleTestCase):
+    def test_native_values_encode_like_serialized_ones(self):
+        native = {"id": uuid.UUID(POOL_A), "curr_value": Decimal("12.50")}
+        serialized = {"id": POOL_A, "curr_value": "12.50"}
+        self.assertEqual(pack(native), pack(serialized))
+        self.assertEqual(encode(native), encode(serialized))
+        self.assertEqual(encode(native, MSGPACK), encode(serialized, MSGPACK))
+
+    def test_cached_auth_head_and_tail_make_one_frame(self):
+        pools, invs = [{"id": POOL_A, "curr_value": "1.00"}], [{"user_id": USER_A, "pool_id": POOL_A}]
+        tails = {
+            JSON: ', "user": null, "dash": []}, "seq": {"events": "1-0"}}',
+            MSGPACK: pack("user") + pack(None) + pack("dash") + pack([]) + pack("seq") + pack({"events": "1-0"}),
+        }
+        with mock.patch.object(snapshot_cache, "pools_json", return_value=json.dumps(pools)), \
+                mock.patch.object(snapshot_cache, "invs_json", return_value=json.dumps(invs)), \
+                mock.patch.object(snapshot_cache, "pools_msgpack", return_value=pack(pools)), \
+                mock.patch.object(snapshot_cache, "invs_msgpack", return_value=pack(invs)):
+            for codec, tail in tails.items():
+                head = PoolConsumer.auth_head(codec)
+                frame = zlib.decompress(Prefix(head).compress(tail))
+                message = unpack(frame) if codec == MSGPACK else json.loads(frame)
+                self.assertEqual(message, {
+                    "type": "auth",
+                    "data": {"pools": pools, "invs": invs, "user": None, "dash": []},
+                    "seq": {"events": "1-0"},
+                })
+
+
+class ValuationTests(SimpleTestCase):
+    POOL = {
+        "id": POOL_A, "user_id": USER_A, "active": "BTC", "is_long": True, "is_order": False, "order": "100",
+        "final_amount": "100.00", "stop_loss": 0, "take_profit": 0, "leverage": "1.00", "curr_value": "100.00",
+        "in_amount": 0, "is_closed": False, "total_invested": "0.00", "investor_count": 0,
+    }
+
+    def test_only_checked_fields_are_published(self):
+        pool = PoolConsumer.client_pool({"id": POOL_A, "in_amount": "3", "order": "1", "leverage": "100"})
+        self.assertEqual(pool, {"id": POOL_A, "in_amount": 3})
+
+    def test_book_is_built_from_create_events_only(self):
+        engine = ValuationEngine()
+        engine.apply(INVESTMENTS_CHANNEL, json.dumps({"pool": self.POOL}))
+        self.assertEqual(engine.assets, {})
+
+        engine.apply(POOLS_CHANNEL, json.dumps({"pool": self.POOL}))
+        engine.apply(INVESTMENTS_CHANNEL, json.dumps({"pool": {**self.POOL, "order": "1", "leverage": "100"}}))
+        engine.set_price("BTC", 101.0)
+        [change] = engine.step()
+        self.assertEqual(change["curr_value"], 101.0)
+
+    def test_values_are_capped_to_the_column(self):
+        book = Book()
+        book.add(POOL_A, True, 100.0, 100.0, 10 ** 7, 0.0, 0, 0, 0.0)
+        changed, _ = book.revalue(1000.0)
+        self.assertEqual((changed, book.value[0]), ([0], MAX_VALUE))
+
+    def test_a_rejected_row_does_not_fail_the_tick(self):
+        changes = [{"id": pk, "curr_value": 1.0, "is_closed": False} for pk in (POOL_A, POOL_B)]
+
+        def bulk_update(objs, fields, batch_size=None):
+            if len(objs) > 1 or str(objs[0].id) == POOL_A:
+                raise DataError("numeric field overflow")
+
+        with mock.patch("app.valuation.transaction.atomic", nullcontext), \
+                mock.patch("app.valuation.TradePool.objects.bulk_update", side_effect=bulk_update), \
+                mock.patch("app.valuation.TelegramUser.objects") as users:
+            users.revalue.return_value, users.realize.return_value = [(USER_B, 5)], []
+            written, scores = ValuationEngine.db_apply.__wrapped__(changes)
+
+        self.assertEqual([change["id"] for change in written], [POOL_B])
+        users.revalue.assert_called_once_with([POOL_B])
+        self.assertEqual(scores, {USER_B: 5})
+
+
+def init_data(**fields) -> dict:
+    fields.setdefault("auth_date", str(int(time.time())))
+    check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    return {**fields, "hash": hmac.new(utils.SECRET_KEY, check.encode(), hashlib.sha256).hexdigest()}
+
+
+class VerifyInitDataTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(utils, "_verified", OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_repeated_init_data_skips_the_hmac(self):
+        data = init_data(user="a")
+        self.assertTrue(utils.verify_telegram_init_data(dict(data)))
+        with mock.patch.object(utils.hmac, "new") as new:
+            self.assertTrue(utils.verify_telegram_init_data(dict(data)))
+        new.assert_not_called()
+
+    def test_bad_hash_is_rejected_and_not_cached(self):
+        data = {**init_data(user="a"), "hash": "0" * 64}
+        self.assertFalse(utils.verify_telegram_init_data(dict(data)))
+        self.assertEqual(len(utils._verified), 0)
+
+    def test_changed_fields_do_not_match_the_cached_hash(self):
+        data = init_data(user="a")
+        self.assertTrue(utils.verify_telegram_init_data(dict(data)))
+        self.assertFalse(utils.verify_telegram_init_data({**data, "user": "b"}))
+
+    def test_stale_auth_date_evicts_the_cached_hash(self):
+        data = init_data(user="a")
+        self.assertTrue(utils.verify_telegram_init_data(dict(data)))
+        with mock.patch.object(utils.time, "time", return_value=time.time() + utils.INIT_DATA_MAX_AGE + 60):
+            self.assertFalse(utils.verify_telegram_init_data(dict(data)))
+        self.assertNotIn(data["hash"], utils._verified)
+
+    def test_cache_keeps_the_most_recently_used_entries(self):
+        first, second, third = (init_data(user=name) for name in "abc")
+        with mock.patch.object(utils, "INIT_DATA_CACHE_SIZE", 2):
+            for data in (first, second, first, third):
+                self.assertTrue(utils.verify_telegram_init_data(dict(data)))
+
+        self.assertEqual(list(utils._verified), [first["hash"], third["hash"]])
+
+
+class Tombstone(SimpleNamespace):
+    pass
+
+
+class Serializer:
+    def __init__(self, rows, many=False):
+        self.data = [row.id for row in rows]
+
+
+class SnapshotPageTests(SimpleTestCase):
+    AT = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def test_cursor_round_trips_and_accepts_a_bare_timestamp(self):
+        pk = uuid.UUID(POOL_A)
+        self.assertEqual(decode_cursor(encode_cursor(self.AT, pk)), (self.AT, pk))
+        self.assertEqual(decode_cursor(self.AT.isoformat()), (self.AT, None))
+        self.assertIsNone(decode_cursor(None))
+        with self.assertRaises(ValueError):
+            decode_cursor("not a cursor")
+
+    def test_after_filters_past_the_cursor_row(self):
+        queryset = mock.MagicMock()
+        qs = queryset.order_by.return_value
+        pk = uuid.UUID(POOL_A)
+
+        after(queryset, (self.AT, pk), "updated_at")
+
+        queryset.order_by.assert_called_once_with("updated_at", "id")
+        qs.filter.assert_called_once_with(Q(updated_at__gt=self.AT) | Q(updated_at=self.AT, id__gt=pk))
+
+    def test_deletions_interleave_with_changes_in_keyset_order(self):
+        minute = datetime.timedelta(minutes=1)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rows = [
+            SimpleNamespace(id=uuid.UUID(int=1), updated_at=now),
+            SimpleNamespace(id=uuid.UUID(int=3), updated_at=now + minute),
+        ]
+        gone = [Tombstone(id=uuid.UUID(int=2), user_id=USER_A, pool_id=POOL_A, deleted_at=now)]
+        tombstones = mock.MagicMock(model=Tombstone)
+
+        def fake_after(queryset, cursor, field):
+            return gone if field == "deleted_at" else rows
+
+        token = encode_cursor(now - minute, uuid.UUID(int=0))
+        with mock.patch("app.snapshot.after", side_effect=fake_after):
+            page = changes_page(mock.MagicMock(), Serializer, token, page_size=2, tombstones=tombstones)
+
+        self.assertEqual(page["items"], [uuid.UUID(int=1)])
+        self.assertEqual(page["deleted"], [{"id": str(uuid.UUID(int=2)), "user_id": USER_A, "pool_id": POOL_A}])
+        self.assertEqual(decode_cursor(page["cursor"]), (now, uuid.UUID(int=2)))
+        self.assertTrue(page["more"])
+
+    def test_expired_cursor_resets_the_client(self):
+        token = encode_cursor(self.AT, uuid.UUID(POOL_A))
+        page = changes_page(mock.MagicMock(), Serializer, token, tombstones=mock.MagicMock(model=Tombstone))
+        self.assertTrue(page["reset"])
+        self.assertIsNone(page["cursor"])
+
+
+class Rows(list):
+    def values_list(self, *fields):
+        return [tuple(getattr(row, field) for field in fields) for row in self]
+
+
+class FastSerializerTests(SimpleTestCase):
+    def test_pools_serialize_like_the_model_serializer(self):
+        pools = Rows([
+            TradePool(user_id=uuid.UUID(USER_A), active="BTC", is_long=True, is_order=True,
+                      order=Decimal("65000.1234567891"), final_amount=Decimal("1000.5"), stop_loss=-10,
+                      take_profit=10, leverage=Decimal("2"), curr_value=Decimal(1) / 7, in_amount=3,
+                      total_invested=Decimal("12.345"), investor_count=2),
+            TradePool(user_id=uuid.UUID(USER_B), active="ETH", is_long=False, is_order=False, order=None,
+                      final_amount=Decimal("0"), stop_loss=0, take_profit=0, leverage=Decimal("1.5")),
+        ])
+        self.assertEqual(trade_pool_fast.serialize(pools), TradePoolSerializer(pools, many=True).data)
+
+    def test_investments_serialize_like_the_model_serializer(self):
+        investments = Rows([
+            TradeInvestment(user_id=uuid.UUID(USER_A), pool_id=uuid.UUID(POOL_A), input=Decimal("12.3")),
+            TradeInvestment(user_id=uuid.UUID(USER_B), pool_id=uuid.UUID(POOL_B), input=Decimal("0.005")),
+        ])
+        self.assertEqual(trade_investment_fast.serialize(investments),
+                         TradeInvestmentSerializer(investments, many=True).data)
+
+
+class HandlerValidateTests(SimpleTestCase):
+    handler = Handler("trade_pool", "update", lambda consumer, params: None,
+                      required={"pool": dict}, optional={"amount": NULLABLE_NUMBER})
+
+    def test_valid_params_are_returned_unchanged(self):
+        params = {"pool": {}, "amount": None, "extra": 1}
+        self.assertIs(self.handler.validate(params), params)
+        self.assertEqual(self.handler.validate({"pool": {}}), {"pool": {}})
+
+    def test_invalid_params_are_rejected(self):
+        for params, message in [
+            ([], "params must be an object"),
+            (None, "missing param: pool"),
+            ({"amount": 1}, "missing param: pool"),
+            ({"pool": []}, "invalid param: pool"),
+            ({"pool": {}, "amount": []}, "invalid param: amount"),
+        ]:
+            with self.subTest(params=params), self.assertRaisesMessage(ValidationError, message):
+                self.handler.validate(params)
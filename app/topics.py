@@ -0,0 +1,46 @@
+import uuid
+
+from project import settings
+
+MAX_SUBSCRIPTIONS = getattr(settings, "MAX_SUBSCRIPTIONS", 500)
+
+# Sockets that never subscribe stay in "main" and get every event, as before.
+# Subscribed sockets leave "main" for the market-wide "pools" (new pools) and
+# "dash" groups plus one group per watched pool / user.
+MAIN_GROUP = "main"
+POOLS_GROUP = "pools"
+DASH_GROUP = "dash"
+
+
+def pool_group(pool_id) -> str:
+    return f"pool.{uuid.UUID(str(pool_id))}"
+
+
+def user_group(user_id) -> str:
+    return f"user.{uuid.UUID(str(user_id))}"
+
+
+def event_groups(m_type: str, data: dict | None) -> list[str]:
+    """
+    Groups an event published on ``main.*`` has to reach. An event that
+    matches several topics of one socket is sent to each of them; the
+    socket's outbox keeps one copy by event id (see ``Outbox.put``).
+    """
+    if m_type == "dash":
+        return [MAIN_GROUP, DASH_GROUP]
+    if m_type == "pool":
+        return [MAIN_GROUP, POOLS_GROUP]
+
+    groups = [MAIN_GROUP]
+    try:
+        pool = data.get("pool", None)
+        if pool and pool.get("id", None) is not None:
+            groups.append(pool_group(pool["id"]))
+        for inv in (data.get("investment", None), data.get("deleted", None)):
+            if inv:
+                groups.append(pool_group(inv["pool_id"]))
+                groups.append(user_group(inv["user_id"]))
+    except (KeyError, ValueError):
+        pass
+
+    return list(dict.fromkeys(groups))
@@ -1,12 +1,33 @@
 import hashlib
 import hmac
 import logging
+import time
+from collections import OrderedDict
 
 from project import settings
 
 logger = logging.getLogger("auth")
 
 TOKEN_BOT = settings.TOKEN_BOT
+INIT_DATA_MAX_AGE = getattr(settings, "INIT_DATA_MAX_AGE", 24 * 60 * 60)
+INIT_DATA_CACHE_SIZE = getattr(settings, "INIT_DATA_CACHE_SIZE", 10_000)
+
+# Derived from the bot token only, so computed once instead of per auth.
+SECRET_KEY = hmac.new("WebAppData".encode(), TOKEN_BOT.encode(), hashlib.sha256).digest()
+
+# hash -> data_check_string of initData that already passed the HMAC check.
+_verified: OrderedDict[str, str] = OrderedDict()
+
+
+def is_fresh(init_data: dict) -> bool:
+    if not INIT_DATA_MAX_AGE:
+        return True
+    try:
+        auth_date = int(init_data.get('auth_date', 0))
+    except ValueError:
+        return False
+    return time.time() - auth_date <= INIT_DATA_MAX_AGE
+
 
 def verify_telegram_init_data(init_data: dict) -> bool:
     """Проверка подлинности данных, присланных Telegram"""
@@ -15,9 +36,25 @@ def verify_telegram_init_data(init_data: dict) -> bool:
         logger.debug(f"Not token hash: {token_hash}")
         return False
 
+    # Checked before the cache so an entry stops being accepted once its
+    # auth_date is too old.
+    if not is_fresh(init_data):
+        logger.debug(f"Stale init data, auth_date: {init_data.get('auth_date')}")
+        _verified.pop(token_hash, None)
+        return False
+
     data_check_string = '\n'.join(f'{k}={v}' for k, v in sorted(init_data.items()))
 
-    secret_key = hmac.new("WebAppData".encode(), TOKEN_BOT.encode(), hashlib.sha256).digest()
-    calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    # Reconnects resend the same initData: a string compare replaces the HMAC.
+    if _verified.get(token_hash) == data_check_string:
+        _verified.move_to_end(token_hash)
+        return True
+
+    calculated_hash = hmac.new(SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(calculated_hash, token_hash):
+        return False
 
-    return hmac.compare_digest(calculated_hash, token_hash)
\ No newline at end of file
+    _verified[token_hash] = data_check_string
+    if len(_verified) > INIT_DATA_CACHE_SIZE:
+        _verified.popitem(last=False)
+    return True
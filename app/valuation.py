@@ -0,0 +1,323 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from array import array
+from decimal import Decimal
+
+from django.db import DataError, transaction
+from django.utils import timezone
+
+from app.db import database_sync_to_async
+from app.leaderboard import leaderboard
+from app.models import TelegramUser, TradePool
+from app import events
+from app.redis_pool import get_redis
+from app.session import queue_changed
+from app.sharding import INVESTMENTS_CHANNEL, POOLS_CHANNEL
+from project import settings
+
+logger = logging.getLogger("valuation")
+
+# With the engine running, curr_value is the server's: clients' values in
+# trade_pool/update are ignored.
+VALUATION_ENABLED = getattr(settings, "VALUATION_ENABLED", False)
+VALUATION_TICK = getattr(settings, "VALUATION_TICK", 1.0)
+
+# Price feed: "prices.<ASSET>" carrying the price as a plain number.
+PRICES_CHANNEL = "prices"
+
+CENT = Decimal("0.01")
+# Largest value TradePool.curr_value holds; computed values are capped to it.
+_field = TradePool._meta.get_field("curr_value")
+MAX_VALUE = float(10 ** (_field.max_digits - _field.decimal_places)) - 0.01
+
+
+class Book:
+    """
+    Open positions on one asset as parallel arrays, so a price tick is one
+    pass over contiguous doubles instead of a walk over model instances.
+    Removal swaps the last slot into the freed one.
+    """
+
+    def __init__(self):
+        self.ids: list[str] = []
+        self.slots: dict[str, int] = {}
+        self.sign = array("d")
+        self.entry = array("d")
+        self.leverage = array("d")
+        self.amount = array("d")
+        self.invested = array("d")
+        self.stop = array("d")
+        self.take = array("d")
+        self.value = array("d")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, pool_id: str, is_long: bool, entry: float, leverage: float, amount: float,
+            invested: float, stop_loss: float, take_profit: float, value: float) -> None:
+        # stop_loss / take_profit are percent moves of the position; 0 is "not set".
+        row = (
+            1.0 if is_long else -1.0,
+            entry,
+            leverage,
+            amount,
+            invested,
+            -stop_loss / 100 if stop_loss else -math.inf,
+            take_profit / 100 if take_profit else math.inf,
+            value,
+        )
+        columns = (self.sign, self.entry, self.leverage, self.amount, self.invested, self.stop, self.take, self.value)
+        slot = self.slots.get(pool_id, None)
+        if slot is None:
+            self.slots[pool_id] = len(self.ids)
+            self.ids.append(pool_id)
+            for column, item in zip(columns, row):
+                column.append(item)
+        else:
+            for column, item in zip(columns, row):
+                column[slot] = item
+
+    def set_invested(self, pool_id: str, invested: float) -> None:
+        slot = self.slots.get(pool_id, None)
+        if slot is not None:
+            self.invested[slot] = invested
+
+    def remove(self, pool_id: str) -> None:
+        slot = self.slots.pop(pool_id, None)
+        if slot is None:
+            return
+        last = len(self.ids) - 1
+        for column in (self.ids, self.sign, self.entry, self.leverage, self.amount, self.invested,
+                       self.stop, self.take, self.value):
+            column[slot] = column[last]
+            column.pop()
+        if slot != last:
+            self.slots[self.ids[slot]] = slot
+
+    def revalue(self, price: float) -> tuple[list[int], list[int]]:
+        """
+        Recompute every position at ``price``. Returns the slots whose value
+        moved by at least a cent and the slots that hit stop-loss or
+        take-profit.
+        """
+        moves = [s * l * (price / e - 1) for s, l, e in zip(self.sign, self.leverage, self.entry)]
+        values = [
+            min(MAX_VALUE, max(0.0, round((a + i) * (1 + m), 2)))
+            for a, i, m in zip(self.amount, self.invested, moves)
+        ]
+        changed = [i for i, (new, old) in enumerate(zip(values, self.value)) if new != old]
+        closed = [i for i, (m, lo, hi) in enumerate(zip(moves, self.stop, self.take)) if m <= lo or m >= hi]
+        self.value = array("d", values)
+        return changed, closed
+
+
+class ValuationEngine:
+    """
+    Values every open pool from the price feed. Prices are collected as they
+    arrive; once per ``tick`` each asset whose price moved is revalued in one
+    pass, and all resulting changes go out as one DB update and one
+    pipelined publish.
+
+    Pools are loaded from the DB, then kept current from the ``main.*``
+    events: new pools from the server's create events only, and
+    ``total_invested`` changes from the write-behind flush.
+    """
+
+    def __init__(self, tick: float = VALUATION_TICK):
+        self.tick = tick
+        self.books: dict[str, Book] = {}
+        self.assets: dict[str, str] = {}
+        self.prices: dict[str, float] = {}
+        self._moved: set[str] = set()
+
+        self.passes = 0
+        self.last_pass_seconds = 0.0
+
+    def track(self, pool: dict) -> None:
+        if pool.get("is_order", False) or pool.get("is_closed", False) or not float(pool.get("order", None) or 0) > 0:
+            return
+        pool_id = str(pool["id"])
+        asset = pool["active"]
+        previous = self.assets.get(pool_id, None)
+        if previous is not None and previous != asset:
+            self.books[previous].remove(pool_id)
+        self.assets[pool_id] = asset
+        self.books.setdefault(asset, Book()).add(
+            pool_id,
+            bool(pool["is_long"]),
+            float(pool["order"]),
+            float(pool["leverage"]),
+            float(pool["final_amount"]),
+            float(pool.get("total_invested", 0) or 0),
+            float(pool["stop_loss"]),
+            float(pool["take_profit"]),
+            float(pool.get("curr_value", 0) or 0),
+        )
+
+    def untrack(self, pool_id: str) -> None:
+        asset = self.assets.pop(pool_id, None)
+        if asset is not None:
+            self.books[asset].remove(pool_id)
+
+    def apply(self, channel: str, raw: str) -> None:
+        data = json.loads(raw)
+        pool = data.get("pool", None) if isinstance(data, dict) else None
+        if not pool or pool.get("id", None) is None:
+            return
+        pool_id = str(pool["id"])
+        if pool.get("is_closed", False):
+            self.untrack(pool_id)
+        elif channel.startswith(POOLS_CHANNEL):
+            # The serialized row of a pool just created (consumers.publish_pool).
+            self.track(pool)
+        elif "total_invested" in pool and pool_id in self.assets:
+            self.books[self.assets[pool_id]].set_invested(pool_id, float(pool["total_invested"]))
+
+    def set_price(self, asset: str, price: float) -> None:
+        if 0 < price < math.inf and self.prices.get(asset, None) != price:
+            self.prices[asset] = price
+            self._moved.add(asset)
+
+    def step(self) -> list[dict]:
+        """One valuation pass over the assets whose price moved."""
+        started = time.perf_counter()
+        changes = []
+        moved, self._moved = self._moved, set()
+        for asset in moved:
+            book = self.books.get(asset, None)
+            if not book:
+                continue
+            changed, closed = book.revalue(self.prices[asset])
+            closed_ids = {book.ids[i] for i in closed}
+            changes += [
+                {"id": book.ids[i], "curr_value": book.value[i], "is_closed": book.ids[i] in closed_ids}
+                for i in set(changed) | set(closed)
+            ]
+            for pool_id in closed_ids:
+                self.untrack(pool_id)
+
+        self.passes += 1
+        self.last_pass_seconds = time.perf_counter() - started
+        return changes
+
+    async def run(self) -> None:
+        while True:
+            pubsub = get_redis().pubsub()
+            try:
+                # Subscribe before loading so nothing published during the
+                # load is missed.
+                await pubsub.psubscribe(f"{PRICES_CHANNEL}.*", "main.*")
+                await self.reload()
+                tick_at = time.monotonic() + self.tick
+
+                while True:
+                    msg = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=max(0.0, tick_at - time.monotonic()),
+                    )
+                    if msg is not None and msg["type"] == "pmessage":
+                        if msg["channel"].startswith(PRICES_CHANNEL + "."):
+                            asset = msg["channel"][len(PRICES_CHANNEL) + 1:]
+                            try:
+                                price = float(msg["data"])
+                            except ValueError:
+                                logger.warning(f"skipping unparsable price for {asset}: {msg['data']!r}")
+                                continue
+                            self.set_price(asset, price)
+                        else:
+                            self.apply(msg["channel"], msg["data"])
+
+                    if time.monotonic() >= tick_at:
+                        tick_at = time.monotonic() + self.tick
+                        changes = self.step()
+                        if changes:
+                            changes, scores = await self.db_apply(changes)
+                            await self.publish(changes, list(scores))
+                            if scores:
+                                await leaderboard.set_scores(scores)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.exception(str(ex))
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def reload(self) -> None:
+        self.books, self.assets = {}, {}
+        for pool in await self.db_open_pools():
+            self.track(pool)
+        self._moved = set(self.prices)
+        logger.info(f"valuing {len(self.assets)} open pools on {len(self.books)} assets")
+
+    @staticmethod
+    async def publish(changes: list[dict], users: list[str]) -> None:
+        # users: whose pnl the tick changed, for the user caches.
+        async with get_redis().pipeline(transaction=False) as pipe:
+            queue_changed(pipe, users)
+            for change in changes:
+                message = {
+                    "pool": {
+                        "id": change["id"],
+                        "curr_value": f"{change['curr_value']:.2f}",
+                        "is_closed": change["is_closed"],
+                    },
+                    "investment": None,
+                }
+                events.queue(pipe, INVESTMENTS_CHANNEL, message)
+            await pipe.execute()
+
+    @staticmethod
+    @database_sync_to_async
+    def db_open_pools() -> list[dict]:
+        return list(
+            TradePool.objects
+            .filter(is_closed=False, is_order=False, order__isnull=False)
+            .values("id", "active", "is_long", "is_order", "order", "leverage", "final_amount",
+                    "total_invested", "stop_loss", "take_profit", "curr_value")
+        )
+
+    @staticmethod
+    @database_sync_to_async
+    def db_apply(changes: list[dict]) -> tuple[list[dict], dict[str, int]]:
+        """
+        Write the tick's pool values and the owners' pnl. Returns the changes
+        that were written and the new scores.
+        """
+        now = timezone.now()
+        fields = ["curr_value", "is_closed", "updated_at"]
+        # Rows locked in id order, like every other multi-row write, so two
+        # writers cannot deadlock on each other's rows.
+        changes = sorted(changes, key=lambda change: str(change["id"]))
+        pools = [
+            TradePool(
+                id=change["id"],
+                curr_value=Decimal(change["curr_value"]).quantize(CENT),
+                is_closed=change["is_closed"],
+                updated_at=now,
+            )
+            for change in changes
+        ]
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    TradePool.objects.bulk_update(pools, fields, batch_size=5000)
+            except DataError as ex:
+                # A row the table rejects must not stall every other pool:
+                # write them one by one and leave that one out.
+                logger.error(f"tick update failed, writing pools one by one: {ex}")
+                written = []
+                for change, pool in zip(changes, pools):
+                    try:
+                        with transaction.atomic():
+                            TradePool.objects.bulk_update([pool], fields)
+                        written.append(change)
+                    except DataError as ex:
+                        logger.error(f"skipping value {change['curr_value']} of pool {change['id']}: {ex}")
+                changes = written
+            scores = TelegramUser.objects.revalue([c["id"] for c in changes if not c["is_closed"]])
+            scores += TelegramUser.objects.realize([c["id"] for c in changes if c["is_closed"]])
+        return changes, {str(user_id): pnl for user_id, pnl in scores}
@@ -0,0 +1,114 @@
+"""
+Wire formats for PoolConsumer frames.
+
+JSON frames go out as ``text_data``, msgpack frames as ``bytes_data``. Both
+carry the same values: UUIDs and Decimals are strings, as the serializers
+return them, whichever path (snapshot cache, DB, delta page, broadcast) the
+frame was built on.
+
+Connections that ask for compression get frames of at least
+``COMPRESS_THRESHOLD`` bytes as a zlib stream in ``bytes_data``, whatever the
+format. Such frames always start with 0x78, which neither a JSON frame (sent
+as text anyway) nor a msgpack map can, so clients tell them apart by the first
+byte.
+"""
+import json
+import uuid
+import zlib
+from decimal import Decimal
+
+import msgpack
+
+from project import settings
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+WIRE_FORMATS = getattr(settings, "WIRE_FORMATS", (JSON, MSGPACK))
+COMPRESS_THRESHOLD = getattr(settings, "COMPRESS_THRESHOLD", 16 * 1024)
+COMPRESS_LEVEL = getattr(settings, "COMPRESS_LEVEL", 6)
+
+
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, Decimal):
+        return f"{obj:f}"
+    raise TypeError(f"cannot encode {type(obj).__name__}")
+
+
+def pack(obj) -> bytes:
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def unpack(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+def encode(obj, codec: str = JSON) -> str | bytes:
+    if codec == MSGPACK:
+        return pack(obj)
+    return json.dumps(obj, default=_default)
+
+
+def decode(frame: str | bytes, codec: str = JSON):
+    if codec == MSGPACK and isinstance(frame, (bytes, bytearray)):
+        return unpack(frame)
+    return json.loads(frame)
+
+
+def compress(frame: str | bytes, level: int = COMPRESS_LEVEL) -> bytes:
+    if isinstance(frame, str):
+        frame = frame.encode()
+    return zlib.compress(frame, level)
+
+
+def compressed(frame: str | bytes | None) -> bytes | None:
+    # Only frames above the threshold are worth the CPU.
+    if frame is None or len(frame) < COMPRESS_THRESHOLD:
+        return None
+    return compress(frame)
+
+
+def is_compressed(frame: str | bytes) -> bool:
+    return isinstance(frame, (bytes, bytearray)) and frame[:1] == b"\x78"
+
+
+def broadcast_frames(text: str, packed: bytes | None) -> dict:
+    """
+    Every variant of one broadcast a consumer may send, so each is encoded
+    and compressed once per event instead of once per socket.
+    """
+    return {"text": text, "bytes": packed, "text_z": compressed(text), "bytes_z": compressed(packed)}
+
+
+class Prefix:
+    """
+    The compressed start ``head`` shared by many frames. ``compress(tail)``
+    finishes one frame from a copy of the stream, so per frame only the
+    tail is compressed.
+    """
+
+    def __init__(self, head: str | bytes, level: int = COMPRESS_LEVEL):
+        if isinstance(head, str):
+            head = head.encode()
+        self.size = len(head)
+        self._stream = zlib.compressobj(level)
+        self._out = self._stream.compress(head)
+
+    def compress(self, tail: str | bytes) -> bytes:
+        if isinstance(tail, str):
+            tail = tail.encode()
+        stream = self._stream.copy()
+        return self._out + stream.compress(tail) + stream.flush()
+
+
+def map_header(n: int) -> bytes:
+    # Header of a msgpack map whose packed keys and values follow, so cached
+    # payloads can be spliced into a frame without re-encoding them.
+    if n < 16:
+        return bytes([0x80 | n])
+    if n < 0x10000:
+        return b"\xde" + n.to_bytes(2, "big")
+    return b"\xdf" + n.to_bytes(4, "big")
+
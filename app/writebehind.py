@@ -0,0 +1,401 @@
+import asyncio
+import logging
+import time
+import uuid
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.db import DataError, IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from app import events
+from app.db import database_sync_to_async
+from app.metrics import Gauge
+from app.models import TelegramUser, TradePool, TradeInvestment, TradeInvestmentTombstone
+from app.redis_pool import get_redis
+from app.session import queue_changed, user_cache
+from app.sharding import INVESTMENTS_CHANNEL
+from project import settings
+
+logger = logging.getLogger("writebehind")
+
+WRITE_BEHIND_INTERVAL = getattr(settings, "WRITE_BEHIND_INTERVAL", 0.05)
+WRITE_BEHIND_MAX_PENDING = getattr(settings, "WRITE_BEHIND_MAX_PENDING", 5000)
+# Longest pause between retries while the DB is unreachable.
+WRITE_BEHIND_MAX_BACKOFF = getattr(settings, "WRITE_BEHIND_MAX_BACKOFF", 5.0)
+
+InvKey = tuple[str, str]
+
+# Client-reported TradePool columns written by update_pool.
+POOL_FIELDS = ("curr_value", "in_amount")
+
+
+def inv_key(data: dict) -> InvKey:
+    # Normalised so keys match str(model.user_id) / str(model.pool_id).
+    try:
+        return str(uuid.UUID(str(data["user_id"]))), str(uuid.UUID(str(data["pool_id"])))
+    except (KeyError, ValueError):
+        raise ValueError("investment needs a valid user_id and pool_id")
+
+
+def clean_decimal(model, name: str, value, minimum: Decimal | None = None) -> Decimal:
+    """``value`` as a Decimal that fits ``model.name``; ValueError otherwise."""
+    field = model._meta.get_field(name)
+    try:
+        number = Decimal(str(value))
+    except ArithmeticError:
+        number = None
+    if (isinstance(value, bool) or number is None or not number.is_finite()
+            or abs(number) >= Decimal(10) ** (field.max_digits - field.decimal_places)
+            or (minimum is not None and number < minimum)):
+        raise ValueError(f"invalid {name}: {value!r}")
+    return number.quantize(Decimal(1).scaleb(-field.decimal_places))
+
+
+def clean_count(name: str, value, maximum: int = 2 ** 31) -> int:
+    # PositiveIntegerField: 0 .. 2**31 - 1 on Postgres.
+    try:
+        number = Decimal(str(value))
+    except ArithmeticError:
+        number = None
+    if (isinstance(value, bool) or number is None or not number.is_finite()
+            or number != number.to_integral_value() or not 0 <= number < maximum):
+        raise ValueError(f"invalid {name}: {value!r}")
+    return int(number)
+
+
+def clean_pool(data: dict) -> dict:
+    """The POOL_FIELDS present in a client pool update, checked against the columns."""
+    try:
+        pk = str(uuid.UUID(str(data["id"])))
+    except (KeyError, ValueError):
+        raise ValueError("pool needs a valid id")
+    fields = {}
+    if "curr_value" in data:
+        fields["curr_value"] = clean_decimal(TradePool, "curr_value", data["curr_value"])
+    if "in_amount" in data:
+        # Part of the pool's capital: kept to the scale of curr_value.
+        field = TradePool._meta.get_field("curr_value")
+        fields["in_amount"] = clean_count(
+            "in_amount", data["in_amount"], maximum=10 ** (field.max_digits - field.decimal_places),
+        )
+    return {"id": pk, **fields}
+
+
+def clean_investment(data: dict) -> dict:
+    user_id, pool_id = inv_key(data)
+    return {
+        "user_id": user_id,
+        "pool_id": pool_id,
+        "input": clean_decimal(TradeInvestment, "input", data.get("input", 0), minimum=Decimal(0)),
+        "amount": clean_decimal(TradeInvestment, "input", data.get("amount", 0)),
+    }
+
+
+class Batch:
+    """
+    Coalesced writes for one flush window. Within a batch deletes are applied
+    before upserts, so "delete then invest again" on the same key still ends
+    with a fresh row.
+
+    Investment entries keep the semantics of the old check/create/update
+    path: the first message creates the row with its ``input`` if the row
+    does not exist, every message adds its ``amount`` otherwise, and later
+    messages in the same window always add their ``amount``. That maps onto
+    one ``TradeInvestment.objects.upsert`` row per key.
+    """
+
+    def __init__(self):
+        self.pools: dict[str, dict] = {}
+        self.invs: dict[InvKey, dict] = {}
+        self.deletes: set[InvKey] = set()
+        self.retries = 0
+
+    def __len__(self) -> int:
+        return len(self.pools) + len(self.invs) + len(self.deletes)
+
+    def update_pool(self, data: dict) -> None:
+        # curr_value is absent when the valuation engine owns it.
+        self.pools.setdefault(str(data["id"]), {}).update(
+            (name, data[name]) for name in POOL_FIELDS if name in data
+        )
+
+    def upsert_investment(self, key: InvKey, entry: dict) -> None:
+        current = self.invs.get(key, None)
+        if current is None:
+            self.invs[key] = entry
+        else:
+            current["rest"] += entry["amount"] + entry["rest"]
+
+    def delete_investment(self, key: InvKey) -> None:
+        self.invs.pop(key, None)
+        self.deletes.add(key)
+
+    def merge(self, later: "Batch") -> None:
+        for pk, fields in later.pools.items():
+            self.pools.setdefault(pk, {}).update(fields)
+        for key in later.deletes:
+            self.delete_investment(key)
+        for key, entry in later.invs.items():
+            self.upsert_investment(key, entry)
+
+    def rows(self) -> list[tuple]:
+        # In the order db_flush applies them: deletes before upserts.
+        return (
+            [("delete", key, None) for key in self.deletes]
+            + [("pool", pk, fields) for pk, fields in self.pools.items()]
+            + [("investment", key, entry) for key, entry in self.invs.items()]
+        )
+
+    @classmethod
+    def of(cls, rows: list[tuple]) -> "Batch":
+        batch = cls()
+        for kind, key, value in rows:
+            if kind == "delete":
+                batch.deletes.add(key)
+            elif kind == "pool":
+                batch.pools[key] = value
+            else:
+                batch.invs[key] = value
+        return batch
+
+    def split(self) -> tuple["Batch", "Batch"]:
+        # Flushing the halves in order keeps a delete ahead of a re-invest
+        # of the same key.
+        rows = self.rows()
+        half = len(rows) // 2
+        return Batch.of(rows[:half]), Batch.of(rows[half:])
+
+
+class WriteBehindQueue:
+    """
+    Rows the DB rejects (DataError, IntegrityError) are isolated and
+    dropped. On any other error, such as a lost connection or a failover,
+    nothing is dropped: the batch is retried with a capped backoff. While
+    that lasts the queue is ``full`` once it holds ``max_pending`` rows,
+    and callers stop taking writes.
+    """
+
+    def __init__(self, interval: float = WRITE_BEHIND_INTERVAL, max_pending: int = WRITE_BEHIND_MAX_PENDING,
+                 max_backoff: float = WRITE_BEHIND_MAX_BACKOFF):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.failing = False
+
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.flushed_rows = 0
+        self.dropped_rows = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self._batch = Batch()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._batch)
+
+    @property
+    def full(self) -> bool:
+        return self.failing and self.depth >= self.max_pending
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "flush_count": self.flush_count,
+            "flush_errors": self.flush_errors,
+            "flushed_rows": self.flushed_rows,
+            "dropped_rows": self.dropped_rows,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+        }
+
+    # The enqueue methods raise ValueError, before queueing anything, for
+    # data the columns cannot hold: one bad row would fail its whole batch.
+    def update_pool(self, data: dict) -> None:
+        self._batch.update_pool(clean_pool(data))
+        self._enqueued()
+
+    def upsert_investment(self, data: dict) -> None:
+        inv = clean_investment(data)
+        self._batch.upsert_investment(
+            (inv["user_id"], inv["pool_id"]),
+            {"input": inv["input"], "amount": inv["amount"], "rest": Decimal(0)},
+        )
+        self._enqueued()
+
+    def delete_investment(self, data: dict) -> None:
+        self._batch.delete_investment(inv_key(data))
+        self._enqueued()
+
+    def _enqueued(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        if self.depth >= self.max_pending:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self.depth:
+                await self.flush()
+
+    async def flush(self) -> None:
+        batch, self._batch = self._batch, Batch()
+        started = time.perf_counter()
+        try:
+            changed = await self.db_flush(batch)
+        except (DataError, IntegrityError) as ex:
+            # A row the DB rejects fails every retry: write the rest without it.
+            self.flush_errors += 1
+            logger.error(f"flush of {len(batch)} rows rejected, isolating bad rows: {ex}")
+            requeue = Batch()
+            await self.isolate(batch, ex, requeue)
+            if len(requeue):
+                await self.retry(requeue)
+            return
+        except Exception as ex:
+            self.flush_errors += 1
+            logger.exception(str(ex))
+            await self.retry(batch)
+            return
+
+        self.failing = False
+        elapsed = time.perf_counter() - started
+        self.flush_count += 1
+        self.flushed_rows += len(batch)
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        await self.announce(changed)
+
+    @staticmethod
+    async def announce(changed: tuple[list, list] | None) -> None:
+        """
+        Publish what a committed flush changed besides the rows themselves:
+        the pools' total_invested and investor_count as pool events (to
+        clients, the snapshot cache and the valuation engine), and the
+        users whose total_invested moved to the user caches.
+        """
+        if not changed:
+            return
+        pools, users = changed
+        for user_id in users:
+            user_cache.invalidate(uuid.UUID(user_id))
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                for pk, total, count in pools:
+                    events.queue(pipe, INVESTMENTS_CHANNEL, {
+                        "pool": {"id": str(pk), "total_invested": f"{total:f}", "investor_count": count},
+                        "investment": None,
+                    })
+                queue_changed(pipe, users)
+                await pipe.execute()
+        except Exception as ex:
+            # Already written: the caches catch up on their next reload.
+            logger.exception(str(ex))
+
+    async def retry(self, batch: Batch) -> None:
+        # The transaction was rolled back: put the batch back in front of
+        # whatever arrived meanwhile and retry after a pause, which also
+        # keeps a full queue from retrying in a tight loop.
+        self.failing = True
+        batch.retries += 1
+        batch.merge(self._batch)
+        self._batch = batch
+        await asyncio.sleep(min(self.max_backoff, self.interval * 2 ** min(batch.retries - 1, 16)))
+
+    async def isolate(self, batch: Batch, error: Exception, requeue: Batch) -> None:
+        """
+        Bisect a batch the DB rejected: halves that go through are written,
+        single rows that still fail are dropped. After any other error the
+        rest of the batch goes to ``requeue``, in order, to be retried.
+        """
+        if len(requeue):
+            requeue.merge(batch)
+            return
+        if len(batch) <= 1:
+            self.dropped_rows += len(batch)
+            logger.error(f"dropping write-behind row {batch.rows()}: {error}")
+            return
+        for half in batch.split():
+            if len(requeue):
+                requeue.merge(half)
+                continue
+            try:
+                changed = await self.db_flush(half)
+                self.flushed_rows += len(half)
+            except (DataError, IntegrityError) as ex:
+                await self.isolate(half, ex, requeue)
+            except Exception as ex:
+                logger.exception(str(ex))
+                requeue.merge(half)
+            else:
+                await self.announce(changed)
+
+    @staticmethod
+    @database_sync_to_async
+    def db_flush(batch: Batch) -> tuple[list, list]:
+        """Write ``batch`` in one transaction. Returns the changed pool aggregates and user ids."""
+        now = timezone.now()
+        # Aggregate deltas, applied in the same transaction as the rows.
+        users: dict[str, Decimal] = {}
+        pools: dict[str, tuple[Decimal, int]] = {}
+
+        def invested(user_id, pool_id, amount, count: int) -> None:
+            user_id, pool_id = str(uuid.UUID(str(user_id))), str(uuid.UUID(str(pool_id)))
+            users[user_id] = users.get(user_id, 0) + amount
+            total, investors = pools.get(pool_id, (0, 0))
+            pools[pool_id] = (total + amount, investors + count)
+
+        with transaction.atomic():
+            if batch.deletes:
+                deleted = TradeInvestment.objects.filter(
+                    reduce(or_, (Q(user_id=u, pool_id=p) for u, p in batch.deletes))
+                ).order_by("id")
+                rows = list(deleted.select_for_update().values_list("id", "user_id", "pool_id", "input"))
+                for _, user_id, pool_id, value in rows:
+                    invested(user_id, pool_id, -value, -1)
+                deleted.delete()
+                TradeInvestmentTombstone.objects.bury([(pk, user_id, pool_id) for pk, user_id, pool_id, _ in rows])
+
+            # One bulk_update per set of reported columns (normally just one),
+            # in id order so concurrent writers lock rows in the same order.
+            groups: dict[tuple, list[TradePool]] = {}
+            for pk, fields in sorted(batch.pools.items()):
+                if fields:
+                    groups.setdefault(tuple(sorted(fields)), []).append(TradePool(id=pk, updated_at=now, **fields))
+            for names, objs in groups.items():
+                TradePool.objects.bulk_update(objs, [*names, "updated_at"])
+
+            if batch.invs:
+                rows = TradeInvestment.objects.upsert([
+                    (u, p, entry["input"] + entry["rest"], entry["amount"] + entry["rest"])
+                    for (u, p), entry in batch.invs.items()
+                ])
+                for _, user_id, pool_id, _, inserted in rows:
+                    entry = batch.invs[(str(uuid.UUID(str(user_id))), str(uuid.UUID(str(pool_id))))]
+                    if inserted:
+                        invested(user_id, pool_id, entry["input"] + entry["rest"], 1)
+                    else:
+                        invested(user_id, pool_id, entry["amount"] + entry["rest"], 0)
+
+            TelegramUser.objects.add_invested(users)
+            return TradePool.objects.add_investments(pools), sorted(users)
+
+
+write_behind = WriteBehindQueue()
+
+for _name in write_behind.stats():
+    Gauge(f"write_behind_{_name}", f"WriteBehindQueue.stats()[{_name!r}]",
+          fn=lambda name=_name: write_behind.stats()[name])